@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Benchmark of step 4 on synthetic proteins and on real cases like testcase_1A2P.
+
+    benchmark.py generate DIR [--confs N] [--free N] [--per-res N] [--density F] [--seed S]
+        Write a synthetic protein to DIR: head3.lst, energies/*.opp and run.prm.
+    benchmark.py run DIR [DIR ...] [--niter N] [--runs N] [--output FILE] [--compare FILE]
+        Time every case in a scratch copy of DIR and write the results to benchmark.json.
+    benchmark.py scale [--sizes N,N,...] [--per-res N] [--density F] [--niter N] [--output FILE] [--compare FILE]
+        Generate synthetic proteins of growing size, free residues are a third of all residues, and time them.
+
+Measured are seconds and peak traced memory of MC_Protein loading stages, read_head3list, group_conformers,
+read_pairwise, residue_pairwise, make_biglist and update_energy, MC steps per second of mc_sample, and steps per
+second read by collectstates.collect. With --compare, every time is also shown as a ratio to the same case of an
+earlier output.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+RUNPRM = os.path.join(os.path.dirname(BIN), "run.prm")
+STAGES = ["read_head3list", "group_conformers", "read_pairwise", "residue_pairwise", "make_biglist", "update_energy"]
+
+
+def generate(folder, n_conf=1000, n_free=100, per_res=5, density=0.1, seed=0):
+    """Write a synthetic protein of n_conf conformers to folder.
+
+    There are n_free free residues of per_res conformers, half of them charged, and single conformer residues for
+    the remaining conformers. A fraction density of residue pairs interact, with occasional strong pairs that make
+    the big list.
+    """
+    rng = np.random.default_rng(seed)
+    n_fixed = n_conf - n_free * per_res
+    if n_fixed < 0:
+        print("   Error: %d free residues of %d conformers need more than %d conformers" % (n_free, per_res, n_conf))
+        sys.exit()
+
+    # residues as lists of (confname, crg, pk0, nh), free residues are acids
+    residues = []
+    for ir in range(n_free + n_fixed):
+        seq = ir + 1
+        if ir < n_free:
+            res = []
+            for k in range(per_res):
+                if k < per_res // 2:
+                    res.append(("ASP-1A%04d_%03d" % (seq, k + 1), -1.0, 4.0, -1))
+                else:
+                    res.append(("ASP01A%04d_%03d" % (seq, k + 1), 0.0, 0.0, 0))
+        else:
+            res = [("ALA01A%04d_001" % seq, 0.0, 0.0, 0)]
+        residues.append(res)
+    order = rng.permutation(len(residues))
+    residues = [residues[i] for i in order]
+
+    os.makedirs(os.path.join(folder, "energies"), exist_ok=True)
+    lines = ["iConf CONFORMER     FL  occ    crg   Em0  pKa0 ne nH    vdw0    vdw1    tors    epol   dsolv   extra"
+             "    history\n"]
+    confnames = []
+    for res in residues:
+        for confname, crg, pk0, nh in res:
+            confnames.append(confname)
+            vdw0, vdw1, tors, epol, dsolv = rng.normal(0.0, [0.5, 1.0, 0.3, 0.5, 0.5])
+            lines.append("%05d %s f 0.00 %6.3f %5d %5.2f %2d %2d %7.3f %7.3f %7.3f %7.3f %7.3f %7.3f %s t\n" % (
+                len(confnames), confname, crg, 0, pk0, 0, nh, vdw0, vdw1, tors, epol, dsolv, 0.0,
+                confname[3:5] + "O000M000"))
+    open(os.path.join(folder, "head3.lst"), "w").writelines(lines)
+
+    # symmetric pairwise of interacting residue pairs
+    n_res = len(residues)
+    start = np.cumsum([0] + [len(res) for res in residues])
+    opp = [[] for i in range(len(confnames))]
+    pairs = np.argwhere(np.triu(rng.random((n_res, n_res)) < density, 1))
+    for ir, jr in pairs.tolist():
+        ele = rng.normal(0.0, 0.3, (len(residues[ir]), len(residues[jr])))
+        if rng.random() < 0.05:
+            ele *= 30.0
+        vdw = np.minimum(rng.exponential(0.1, ele.shape), 5.0) * rng.choice([-1.0, 1.0])
+        for a in range(len(residues[ir])):
+            for b in range(len(residues[jr])):
+                ic = start[ir] + a
+                jc = start[jr] + b
+                opp[ic].append((jc, ele[a, b], vdw[a, b]))
+                opp[jc].append((ic, ele[a, b], vdw[a, b]))
+    for ic in range(len(confnames)):
+        lines = ["%05d %s %8.3f %8.3f %8.3f %8.3f\n" % (jc + 1, confnames[jc], e, v, 0.0, 0.0)
+                 for jc, e, v in sorted(opp[ic])]
+        open(os.path.join(folder, "energies", "%s.opp" % confnames[ic]), "w").writelines(lines)
+
+    # loading is timed, so every run reads head3.lst and energies instead of mc_cache
+    lines = []
+    for line in open(RUNPRM).readlines():
+        if "(MONTE_CACHE)" in line:
+            line = "f" + line[len(line.split()[0]):]
+        lines.append(line)
+    open(os.path.join(folder, "run.prm"), "w").writelines(lines)
+    print("   Synthetic protein of %d conformers, %d free residues, %d interacting residue pairs in %s" %
+          (n_conf, n_free, len(pairs), folder))
+    return
+
+
+def maxrss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 ** 2 if sys.platform == "darwin" else rss / 1024.0
+
+
+def load_stages(MC_Protein, T, results, traced=False):
+    """Load a new MC_Protein stage by stage as its constructor does, and record the seconds of every stage of
+    STAGES, or their peak traced memory when traced. Each stage runs once, on what the stages before it made."""
+    prot = MC_Protein.__new__(MC_Protein)
+
+    def stage(name, func, *args, **kwargs):
+        if traced:
+            tracemalloc.start()
+            value = func(*args, **kwargs)
+            results.setdefault(name, {})["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024.0 ** 2
+            tracemalloc.stop()
+        else:
+            t = time.perf_counter()
+            value = func(*args, **kwargs)
+            results.setdefault(name, {})["seconds"] = time.perf_counter() - t
+        return value
+
+    prot.head3list, prot.confnames = stage("read_head3list", prot.read_head3list)
+    prot.fixed_conformers, prot.free_residues = stage("group_conformers", prot.group_conformers)
+    prot.make_arrays()
+    prot.free_conformers, prot.free_index = prot.index_free_conformers()
+    prot.conf_residue, prot.conf_slot = prot.index_residues()
+    prot.pairwise, prot.free_pairwise, prot.mfe, prot.fixed_pw = stage("read_pairwise", prot.read_pairwise)
+    prot.residue_pw = stage("residue_pairwise", prot.residue_pairwise)
+    prot.biglist = stage("make_biglist", prot.make_biglist)
+    stage("update_energy", prot.update_energy, T=T, ph=7.0, eh=0.0)
+    return prot
+
+
+def measure(niter, runs):
+    """Benchmark the case in the current working directory, return the results."""
+    sys.path.insert(0, BIN)
+    from pymcce import env, MC_Protein, mc_prepdir, mc_sample
+    import collectstates
+
+    # loading is timed from head3.lst and energies, not from mc_cache
+    env.prm["MONTE_CACHE"] = "f"
+    results = {}
+    t = time.perf_counter()
+    prot = MC_Protein()
+    results["MC_Protein"] = {"seconds": time.perf_counter() - t, "maxrss_mb": maxrss_mb()}
+    # stages are timed on a fresh protein, and traced on another, so tracing does not slow the timed one
+    load_stages(MC_Protein, env.prm["MONTE_T"], results)
+    load_stages(MC_Protein, env.prm["MONTE_T"], results, traced=True)
+
+    n_conf = sum([len(res) for res in prot.free_residues])
+    results["size"] = {"conformers": len(prot.head3list), "free_residues": len(prot.free_residues),
+                       "free_conformers": n_conf}
+
+    env.prm["MONTE_NITER"] = niter
+    env.prm["MONTE_RUNS"] = runs
+    env.prm["MONTE_RHAT"] = 0.0
+    n_steps = niter * n_conf * runs
+    mc_prepdir()
+    os.chdir(env.mc_states)
+    t = time.perf_counter()
+    mc_sample(prot, T=env.prm["MONTE_T"], ph=7.0, eh=0.0, seeds=list(range(runs)))
+    seconds = time.perf_counter() - t
+    os.chdir("../")
+    results["mc_sample"] = {"seconds": seconds, "steps_per_second": n_steps / seconds, "maxrss_mb": maxrss_mb()}
+
+    t = time.perf_counter()
+    collectstates.collect(0.1)
+    seconds = time.perf_counter() - t
+    results["collectstates"] = {"seconds": seconds, "steps_per_second": n_steps / seconds, "maxrss_mb": maxrss_mb()}
+    return results
+
+
+def run_case(folder, niter, runs):
+    """Benchmark folder in a scratch copy and a separate process, pymcce reads run.prm at import."""
+    scratch = tempfile.mkdtemp(prefix="pymcce-benchmark-")
+    try:
+        case = os.path.join(scratch, "case")
+        os.mkdir(case)
+        for fname in ["head3.lst", "run.prm", "energies", "extra.tpl", "extra.ftpl"]:
+            source = os.path.join(folder, fname)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(case, fname))
+            elif os.path.isfile(source):
+                shutil.copy(source, os.path.join(case, fname))
+        command = [sys.executable, os.path.abspath(__file__), "measure", "--niter", str(niter), "--runs", str(runs)]
+        output = subprocess.run(command, cwd=case, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    finally:
+        shutil.rmtree(scratch)
+    for line in output.splitlines():
+        if line.startswith("BENCHMARK "):
+            return json.loads(line[len("BENCHMARK "):])
+    return None
+
+
+def report(cases, baseline=None):
+    """Print one line per case, with time ratios to the case of the same name in baseline."""
+    baseline = baseline or {}
+    names = ["MC_Protein"] + STAGES + ["mc_sample", "collectstates"]
+    print("%-28s %7s %5s %6s" % ("case", "confs", "free", "fconfs") + "".join([" %12s" % x[:12] for x in names]) +
+          " %10s %10s" % ("MC step/s", "read st/s"))
+    for name in cases:
+        r = cases[name]
+        line = "%-28s %7d %5d %6d" % (name[-28:], r["size"]["conformers"], r["size"]["free_residues"],
+                                      r["size"]["free_conformers"])
+        for x in names:
+            if name in baseline:
+                line += " %6.3f/%4.2fx" % (r[x]["seconds"], r[x]["seconds"] / max(baseline[name][x]["seconds"], 1e-9))
+            else:
+                line += " %12.3f" % r[x]["seconds"]
+        line += " %10.0f %10.0f" % (r["mc_sample"]["steps_per_second"], r["collectstates"]["steps_per_second"])
+        print(line)
+    print("Peak traced memory in MB: %s" % ", ".join(["%s %s" % (name[-28:], "/".join(
+        ["%.1f" % cases[name][x]["peak_mb"] for x in STAGES])) for name in cases]))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Step 4 benchmark")
+    subparsers = parser.add_subparsers(dest="command")
+
+    p = subparsers.add_parser("generate", help="write a synthetic protein")
+    p.add_argument("folder")
+    p.add_argument("--confs", type=int, default=1000, help="number of conformers, default 1000")
+    p.add_argument("--free", type=int, default=100, help="number of free residues, default 100")
+    p.add_argument("--per-res", type=int, default=5, help="conformers per free residue, default 5")
+    p.add_argument("--density", type=float, default=0.1, help="fraction of interacting residue pairs, default 0.1")
+    p.add_argument("--seed", type=int, default=0, help="random seed, default 0")
+
+    for command in ["run", "scale"]:
+        p = subparsers.add_parser(command, help="time cases" if command == "run" else "time growing proteins")
+        if command == "run":
+            p.add_argument("folders", nargs="+", help="case folders like testcase_1A2P")
+        else:
+            p.add_argument("--sizes", default="250,500,1000,2000", help="conformer counts, default 250,500,1000,2000")
+            p.add_argument("--per-res", type=int, default=5, help="conformers per free residue, default 5")
+            p.add_argument("--density", type=float, default=0.1, help="fraction of interacting residue pairs")
+        p.add_argument("--niter", type=int, default=20, help="MC iterations per free conformer, default 20")
+        p.add_argument("--runs", type=int, default=2, help="MC runs, default 2")
+        p.add_argument("--output", default="benchmark.json", help="result file, default benchmark.json")
+        p.add_argument("--compare", help="earlier result file to compare with")
+
+    p = subparsers.add_parser("measure", help="benchmark the current folder, used by run and scale")
+    p.add_argument("--niter", type=int, default=20)
+    p.add_argument("--runs", type=int, default=2)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args.folder, args.confs, args.free, args.per_res, args.density, args.seed)
+    elif args.command == "measure":
+        print("BENCHMARK %s" % json.dumps(measure(args.niter, args.runs)))
+    elif args.command in ("run", "scale"):
+        baseline = None
+        if args.compare:
+            try:
+                baseline = json.load(open(args.compare))
+            except (OSError, ValueError) as e:
+                print("   Error: Cannot read %s to compare with: %s" % (args.compare, e))
+                sys.exit()
+            if not isinstance(baseline, dict):
+                print("   Error: %s is not a benchmark result file" % args.compare)
+                sys.exit()
+        cases = {}
+        if args.command == "run":
+            for folder in args.folders:
+                print("   Benchmarking %s" % folder)
+                cases[os.path.abspath(folder)] = run_case(folder, args.niter, args.runs)
+        else:
+            for n_conf in [int(x) for x in args.sizes.split(",")]:
+                n_res = n_conf // (args.per_res + 2)
+                name = "synthetic-%d-%d-%g" % (n_conf, args.per_res, args.density)
+                print("   Benchmarking %s" % name)
+                folder = tempfile.mkdtemp(prefix="pymcce-synthetic-")
+                try:
+                    generate(folder, n_conf, n_res, args.per_res, args.density)
+                    cases[name] = run_case(folder, args.niter, args.runs)
+                finally:
+                    shutil.rmtree(folder)
+        report(cases, baseline)
+        json.dump(cases, open(args.output, "w"), indent=1)
+        print("   Results written to %s" % args.output)
+    else:
+        parser.print_help()
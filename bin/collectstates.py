@@ -2,7 +2,7 @@
 """
 Collect unique states from microstates directory.
 It reads in:
-    all ms.gz files
+    all ms.gz files, and msb.gz files in the binary format, in any codec of mscodec.py
 It writes out:
     ph*-eh*-accessibles.stats: divide the states into 6 runs x 20 groups, show average energy abd stdev of each
     ph*-eh*-accessibles:  after discarding a percentage of eq runs, collect accessible states, energy,
@@ -10,10 +10,67 @@ It writes out:
 """
 
 import sys
-import gzip
 import os
 import glob
+import itertools
+import argparse
 import numpy as np
+from msbinary import MSB_Reader
+from mscodec import ms_open, is_microstate_file
+
+class State_key:
+    """Mixed-radix integer key of a microstate over the conformer choice of each free residue.
+
+    A conformer contributes its slot in the residue times the radix of the residue, so the key is updated from state
+    deltas by adding and subtracting conformer weights.
+    """
+    def __init__(self, free_residues):
+        self.free_residues = free_residues
+        self.weight = {}
+        radix = 1
+        for res in free_residues:
+            for slot in range(len(res)):
+                self.weight[res[slot]] = slot * radix
+            radix *= len(res)
+        return
+
+    def encode(self, state):
+        return sum([self.weight[ic] for ic in state])
+
+    def update(self, key, off_confs, on_confs):
+        for ic in off_confs:
+            key -= self.weight[ic]
+        for ic in on_confs:
+            key += self.weight[ic]
+        return key
+
+    def decode(self, key):
+        state = []
+        for res in self.free_residues:
+            key, slot = divmod(key, len(res))
+            state.append(res[slot])
+        state.sort()
+        return tuple(state)
+
+
+def read_free_residues(fname="free_residues.info"):
+    """Read free residues, lists of conformer indices, from the file written by MC_Protein."""
+    if not os.path.isfile(fname):
+        print("   %s not found, it is written by pymonte.py. Quitting ..." % fname)
+        sys.exit()
+
+    free_residues = []
+    res = []
+    lines = open(fname).readlines()
+    lines.pop(0)
+    for line in lines:
+        if line.startswith("."):
+            free_residues.append(res)
+            res = []
+        else:
+            res.append(int(line.split()[1]))
+    return free_residues
+
 
 class State_stat:
     def __init__(self, E):
@@ -24,96 +81,77 @@ class State_stat:
 
 def collect_one(c, t):
     print("collecting microstates at %s and throw_away = %.2f%%. " % (c, t*100))
-    visited = 0
-    # get files at this condition
+    files = condition_files(c)
+    codec = State_key(read_free_residues())
+    results = [collect_file(codec, f, t) for f in files]
+    reduce_condition(c, t, files, results, codec)
+    return
+
+
+def condition_files(c):
     folder = "microstates"
-    pattern = os.path.join(folder, "%s-run*.ms.gz" % c)
-    files = glob.glob(pattern)
+    files = [f for f in glob.glob(os.path.join(folder, "%s-run*" % c)) if is_microstate_file(f)]
     files.sort()
+    return files
 
-    all_states = {}
 
-    std_stat = []
-    number_of_acc = []
-    for f in files:
-        std_stat_f = []
-        print("   Processing file %s" % f)
-        with gzip.open(f, "rb") as fh:
-            lines = fh.readlines()
-        lines = [x.decode() for x in lines]
+def collect_file(codec, f, t):
+    """Count the states of one file after throwing away fraction t of its steps.
 
-        line = lines.pop(0)
-        fields = line.strip().split(",")
-        mc_parm = {}
-        for field in fields:
-            key, value = field.split("=")
-            mc_parm[key.strip()] = float(value)
+    Return the State_stat of every visited State_key in the order of first visit, the energy mean and stdev of 20
+    segments, and the number of steps counted. Return None when the file has no initial state.
+    """
+    print("   Processing file %s" % f)
+    mc_parm, E, state, n_lines, lines = read_ms(f)
+    if state is None:
+        print("   No initial state found. Quitting ...")
+        return None
 
-        T = mc_parm["T"]
-        ph = mc_parm["ph"]
-        eh = mc_parm["eh"]
+    # Now we have initial state in state[], and the rest state deltas streaming from lines, None for a rejected
+    # step. Skip t lines and collect the rest states
+    n_skip = int(t * n_lines)
+    n_record = n_lines - n_skip
+    n_segment = int(n_record/20)
 
-        line = lines.pop(0)
-        E_str, state_str = line.split(":")
-        if state_str:
-            state = [int(ic) for ic in state_str.split(",")]
-            E = float(E_str)
+    states = {}
+    std_stat_f = []
+    counter_line = 0
+    Es = np.zeros(n_segment)
+    for E, key in walk_states(codec, E, state, lines, n_skip):
+        # save it to database
+        if key in states:
+            states[key].counter += 1
         else:
-            print("   No initial state found. Quitting ...")
-            continue
+            states[key] = State_stat(E)
 
-        # Now we have initial state in state[], and the rest state deltas in lines[]
-        # skip t lines
-        n_lines = len(lines)
-        n_skip = int(t * n_lines)
-        state = set(state)
-        for line in lines[:n_skip]:
-            line = line.strip()
-            if line:
-                fields = line.split(":")
-                E = float(fields[0])
-                off_confs, onconfs = conf_delta(fields[1])
-                state = state - off_confs
-                state = state | onconfs
-
-        # collect the rest states
-        state_arr = list(state)
-        state_arr.sort()
-        state_tup = tuple(state_arr)
-
-        n_record = len(lines[n_skip:])
-        n_segment = int(n_record/20)
-
-        counter_line = 0
-        Es = np.zeros(n_segment)
-        for line in lines[n_skip:]:
-            line = line.strip()
-            if line:
-                fields = line.split(":")
-                E = float(fields[0])
-                off_confs, onconfs = conf_delta(fields[1])
-                state = state - off_confs
-                state = state | onconfs
-
-                # got an update
-                state_arr = list(state)
-                state_arr.sort()
-                state_tup = tuple(state_arr)
-
-            # save it to database
-            if state_tup in all_states:
-                all_states[state_tup].counter += 1
-            else:
-                all_states[state_tup] = State_stat(E)
+        # stdev
+        counter_line += 1
+        Es[counter_line-1] = E
+        if counter_line >= n_segment:
+            std_stat_f.append((Es.mean(), Es.std()))
+            counter_line = 0
 
-            # stdev
-            counter_line += 1
-            Es[counter_line-1] = E
-            if counter_line >= n_segment:
-                std_stat_f.append((Es.mean(), Es.std()))
-                counter_line = 0
+    return states, std_stat_f, n_record
 
-        visited += len(lines) - n_skip
+
+def reduce_condition(c, t, files, results, codec):
+    """Merge the collect_file results of the files of condition c in file order and write the outputs."""
+    folder = "microstates"
+    visited = 0
+    all_states = {}
+    std_stat = []
+    number_of_acc = []
+    for result in results:
+        if result is None:
+            continue
+        states, std_stat_f, n_record = result
+        for key, stat in states.items():
+            if key in all_states:
+                all_states[key].counter += stat.counter
+            else:
+                all_states[key] = stat
+
+        visited += n_record
 
         std_stat.append(std_stat_f)
         number_of_acc.append((len(all_states), visited))
@@ -134,12 +172,155 @@ def collect_one(c, t):
     accessibles = sorted(all_states.items(), key=lambda kv:kv[1].E)
     out_lines = []
     for rs in accessibles:
-        out_lines.append("%s:%.3f, %d\n" %(rs[0], rs[1].E, rs[1].counter))
+        out_lines.append("%s:%.3f, %d\n" %(codec.decode(rs[0]), rs[1].E, rs[1].counter))
     open(fn_accessibles, "w").writelines(out_lines)
 
     return
 
 
+_codec = None
+
+
+def _collect_init(codec):
+    global _codec
+    _codec = codec
+    return
+
+
+def _collect_job(job):
+    c, f, t = job
+    return c, collect_file(_codec, f, t)
+
+
+def collect_parallel(titr_conditions, throwaway, workers):
+    """Count every file of every condition in a pool of worker processes, merge each condition when its files are
+    done."""
+    import multiprocessing
+    codec = State_key(read_free_residues())
+    files = {}
+    jobs = []
+    for c in titr_conditions:
+        files[c] = condition_files(c)
+        jobs += [(c, f, throwaway) for f in files[c]]
+
+    pool = multiprocessing.get_context("fork").Pool(workers, initializer=_collect_init, initargs=(codec,))
+    results = {}
+    for c, result in pool.imap(_collect_job, jobs):
+        results.setdefault(c, []).append(result)
+        if len(results[c]) == len(files[c]):
+            print("collected microstates at %s and throw_away = %.2f%%. " % (c, throwaway*100))
+            reduce_condition(c, throwaway, files[c], results.pop(c), codec)
+    pool.close()
+    pool.join()
+    return
+
+
+def walk_states(codec, E, state, steps, n_skip):
+    """Apply the state deltas of MC steps in turn.
+
+    The first n_skip steps are thrown away, then the energy and State_key of every step are yielded.
+    """
+    steps = iter(steps)
+    key = codec.encode(state)
+    for step in itertools.islice(steps, n_skip):
+        if step:
+            E, off_confs, on_confs = step
+            key = codec.update(key, off_confs, on_confs)
+
+    for step in steps:
+        if step:
+            E, off_confs, on_confs = step
+            key = codec.update(key, off_confs, on_confs)
+        yield E, key
+
+    return
+
+
+def read_ms(f):
+    """Open one ms or msb file.
+
+    Return the MC parameters, initial energy and state, the number of MC steps, and a generator of (E, off_confs,
+    on_confs) per MC step, None for a rejected step.
+    """
+    if ".msb" in os.path.basename(f):
+        return read_msb(f)
+
+    with ms_open(f) as fh:
+        line = fh.readline().decode()
+        fields = line.strip().split(",")
+        mc_parm = {}
+        for field in fields:
+            key, value = field.split("=")
+            mc_parm[key.strip()] = float(value)
+
+        line = fh.readline().decode()
+        E_str, state_str = line.split(":")
+        if not state_str:
+            return mc_parm, None, None, 0, iter([])
+        state = [int(ic) for ic in state_str.split(",")]
+        E = float(E_str)
+
+        # count steps in a first pass, the throwaway fraction and segments depend on it
+        n_steps = 0
+        for line in fh:
+            if b":" in line or not line.strip():
+                n_steps += 1
+            else:
+                n_steps += int(line)
+
+    return mc_parm, E, state, n_steps, text_steps(f)
+
+
+def text_steps(f):
+    with ms_open(f) as fh:
+        fh.readline()
+        fh.readline()
+        for line in fh:
+            line = line.decode().strip()
+            if not line:
+                yield None
+            elif ":" in line:
+                fields = line.split(":")
+                off_confs, on_confs = conf_delta(fields[1])
+                yield float(fields[0]), off_confs, on_confs
+            else:
+                # run-length encoded rejected steps
+                for k in range(int(line)):
+                    yield None
+    return
+
+
+def read_msb(f):
+    """Open one binary msb file, returned in the same form as read_ms()."""
+    msb = MSB_Reader(f)
+    return msb.mc_parm, msb.E, msb.state.tolist(), msb.steps, msb_steps(msb)
+
+
+def msb_steps(msb):
+    n_steps = 0
+    for skip, E, n, off, on in msb.chunks():
+        skips = skip.tolist()
+        Es = E.tolist()
+        ns = n.tolist()
+        offs = off.tolist()
+        ons = on.tolist()
+        start = 0
+        for i in range(len(ns)):
+            for k in range(skips[i]):
+                yield None
+            end = start + ns[i]
+            if end > start:
+                yield Es[i], set(offs[start:end]), set(ons[start:end])
+                n_steps += 1
+            start = end
+        n_steps += sum(skips)
+    msb.close()
+
+    for k in range(msb.steps - n_steps):
+        yield None
+    return
+
+
 def conf_delta(line):
     off_confs = set()
     on_confs = set()
@@ -153,10 +334,10 @@ def conf_delta(line):
             on_confs.add(ic)
     return off_confs, on_confs
 
-def collect(throwaway):
+def collect(throwaway, workers=1):
     # compose file names to read
     folder = "microstates"
-    files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and f.endswith(".ms.gz")]
+    files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and is_microstate_file(f)]
     files.sort()
     # analyze how many ph-eh
     titr_conditions = []
@@ -167,15 +348,20 @@ def collect(throwaway):
             titr_conditions.append(c)
 
     print("")
-    for c in titr_conditions:
-        collect_one(c, throwaway)
+    if workers > 1:
+        collect_parallel(titr_conditions, throwaway, workers)
+    else:
+        for c in titr_conditions:
+            collect_one(c, throwaway)
 
     return
 
 
 if __name__ == "__main__":
-    if len(sys.argv) >1:
-        throwaway = float(sys.argv[1])
-    else:
-        throwaway = 0.1
-    collect(throwaway)
+    parser = argparse.ArgumentParser(description="Collect accessible microstates")
+    parser.add_argument("throwaway", nargs="?", type=float, default=0.1,
+                        help="fraction of the steps of every run thrown away as equilibration, default 0.1")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes reading run files of all conditions, default 1")
+    args = parser.parse_args()
+    collect(args.throwaway, args.workers)
@@ -11,11 +11,19 @@ Writes out:
     sumcrg: Total charge table from sampling
     sumcrg.recovery: total charge table from analytical solution
     sumcrg.xts: total charge table with entropy correction
+    pK.out: pKa or Em and Hill coefficient of every ionizable residue fitted from an occupancy table, fort.38 by
+            default, pK.out-eh0 and so on for tables fort.38-eh0 and so on
+    pK.grid: pKa at every Eh and Em at every pH of a grid titration, fitted from all its fort.38-eh# and
+             fort.38-ph#.# tables to their pK.out-eh# and pK.out-ph#.#
 """
 import os
 import sys
+import argparse
+import numpy as np
 
 PH2KCAL = 1.364
+PH2MV = 58.0  # 1 pH unit in mV, the one of the Eh term of the sampled energies in pymcce.py
+LN10 = np.log(10.0)
 
 def titration_range(files):
     ph_range = []
@@ -41,31 +49,254 @@ def recover_counts(fn):
 
     return
 
+
+def read_occupancy(fname):
+    """Read an occupancy table like fort.38, return titration type, points, conformer names and occupancy."""
+    lines = open(fname).readlines()
+    fields = lines[0].split()
+    titration_type = fields[0].lower()
+    points = np.array([float(x) for x in fields[1:]])
+    confnames = []
+    occ = []
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) != len(points) + 1:
+            continue
+        confnames.append(fields[0])
+        occ.append([float(x) for x in fields[1:]])
+    return titration_type, points, confnames, np.array(occ).reshape(-1, len(points))
+
+
+def charged_fractions(confnames, occ):
+    """Fraction of charged conformers of every residue that has charged and neutral conformers.
+
+    Return residue names, the sign of the charged conformers and the fractions, one row per residue.
+    """
+    names = []
+    residues = {}
+    for i in range(len(confnames)):
+        resid = confnames[i][:3] + confnames[i][5:11]
+        if resid not in residues:
+            names.append(resid)
+            residues[resid] = []
+        residues[resid].append(i)
+
+    ionizable = []
+    signs = []
+    fractions = []
+    for resid in names:
+        charged = [i for i in residues[resid] if confnames[i][3] in "+-"]
+        if not charged or len(charged) == len(residues[resid]):
+            continue
+        ionizable.append(resid)
+        signs.append(1.0 if confnames[charged[0]][3] == "+" else -1.0)
+        fractions.append(occ[charged].sum(axis=0))
+    return ionizable, np.array(signs), np.array(fractions).reshape(-1, occ.shape[1])
+
+
+def titration_model(x, x0, n, s):
+    """y = 1/(1 + 10^(s*n*(x-x0))) of every row, returned with dy/dz where z = ln(10)*s*n*(x-x0)."""
+    z = LN10 * (s * n)[:, np.newaxis] * (x[np.newaxis, :] - x0[:, np.newaxis])
+    y = 1.0 / (1.0 + np.exp(np.clip(z, -500.0, 500.0)))
+    return y, -y * (1.0 - y)
+
+
+def crossing_points(x, y):
+    """Where every row of y first crosses 0.5 by linear interpolation, NaN if it does not."""
+    d = y - 0.5
+    change = np.sign(d[:, :-1]) != np.sign(d[:, 1:])
+    crosses = change.any(axis=1)
+    i = np.argmax(change, axis=1)
+    rows = np.arange(len(y))
+    d0 = d[rows, i]
+    d1 = d[rows, i + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x0 = x[i] + (x[i + 1] - x[i]) * d0 / (d0 - d1)
+    x0[~crosses] = np.nan
+    return x0
+
+
+def fit_titration(x, y, s, max_iter=200, tol=1.0e-12):
+    """Least-squares fit of y = 1/(1 + 10^(s*n*(x-x0))) to every row of y at points x.
+
+    s is +1 for a fraction that falls with x and -1 for one that rises. All rows are fitted together by
+    Levenberg-Marquardt with a 2 x 2 system per row. Return midpoints x0, Hill coefficients n and residuals.
+    """
+    x0 = crossing_points(x, y)
+    x0[np.isnan(x0)] = x.mean()
+    n = np.ones(len(y))
+    damping = np.full(len(y), 1.0e-3)
+
+    f, dfdz = titration_model(x, x0, n, s)
+    sse = ((f - y) ** 2).sum(axis=1)
+    for iteration in range(max_iter):
+        r = f - y
+        J0 = dfdz * (-LN10 * s * n)[:, np.newaxis]
+        J1 = dfdz * LN10 * s[:, np.newaxis] * (x[np.newaxis, :] - x0[:, np.newaxis])
+        a = (J0 * J0).sum(axis=1)
+        b = (J0 * J1).sum(axis=1)
+        c = (J1 * J1).sum(axis=1)
+        g0 = -(J0 * r).sum(axis=1)
+        g1 = -(J1 * r).sum(axis=1)
+        a = a * (1.0 + damping) + 1.0e-12
+        c = c * (1.0 + damping) + 1.0e-12
+        det = a * c - b * b
+        trial_x0 = x0 + (c * g0 - b * g1) / det
+        trial_n = np.abs(n + (a * g1 - b * g0) / det)
+
+        trial_f, trial_dfdz = titration_model(x, trial_x0, trial_n, s)
+        trial_sse = ((trial_f - y) ** 2).sum(axis=1)
+        better = trial_sse < sse
+        gain = np.where(better, sse - trial_sse, 0.0)
+        x0 = np.where(better, trial_x0, x0)
+        n = np.where(better, trial_n, n)
+        f = np.where(better[:, np.newaxis], trial_f, f)
+        dfdz = np.where(better[:, np.newaxis], trial_dfdz, dfdz)
+        sse = np.where(better, trial_sse, sse)
+        damping = np.where(better, damping * 0.3, damping * 10.0)
+        if np.all((gain <= tol) & (better | (damping > 1.0e10))):
+            break
+
+    return x0, n, f - y
+
+
+def fit_pka(titration_type, points, confnames, occ):
+    """pKa or Em, Hill coefficient and fit residuals of every ionizable residue of an occupancy table.
+
+    Residues whose charged fraction does not cross 0.5 get NaN, with x0 "<" or ">" the titration range in bound.
+    """
+    names, signs, y = charged_fractions(confnames, occ)
+    if titration_type == "eh":
+        x = points / PH2MV
+        signs = -signs  # oxidized, more positive, conformers go up with eh
+    else:
+        x = points
+
+    crosses = ~np.isnan(crossing_points(x, y))
+    x0 = np.full(len(names), np.nan)
+    n = np.full(len(names), np.nan)
+    residuals = np.full(y.shape, np.nan)
+    x0[crosses], n[crosses], residuals[crosses] = fit_titration(x, y[crosses], signs[crosses])
+    if titration_type == "eh":
+        x0 *= PH2MV
+
+    # out of range, the fraction stays on one side of 0.5
+    low = (y[:, 0] > 0.5) == (signs < 0)
+    bound = np.where(low, "<%.1f" % points.min(), ">%.1f" % points.max())
+    bound[crosses] = ""
+    return names, x0, n, residuals, bound
+
+
+def write_pkout(titration_type, names, x0, n, residuals, bound, fname="pK.out"):
+    if titration_type == "eh":
+        lines = ["%-14s %9s %9s %9s %9s\n" % ("eh", "Em", "n(slope)", "1000*chi2", "max_res")]
+    else:
+        lines = ["%-14s %9s %9s %9s %9s\n" % ("ph", "pKa", "n(slope)", "1000*chi2", "max_res")]
+    for i in range(len(names)):
+        if bound[i]:
+            lines.append("%-14s %9s\n" % (names[i], bound[i]))
+        else:
+            chi2 = (residuals[i] ** 2).sum()
+            lines.append("%-14s %9.3f %9.3f %9.3f %9.3f\n" % (names[i], x0[i], n[i], 1000.0 * chi2,
+                                                              np.abs(residuals[i]).max()))
+    open(fname, "w").writelines(lines)
+    return
+
+def pkout_name(table):
+    """pK.out name of an occupancy table, pK.out-eh0 for fort.38-eh0."""
+    name = os.path.basename(table)
+    if name.startswith("fort.38") and name != "fort.38":
+        return "pK.out" + name[len("fort.38"):]
+    return "pK.out"
+
+
+def grid_tables():
+    """Occupancy tables of a grid titration, pH titrations fort.38-eh# then Eh titrations fort.38-ph#.#."""
+    tables = []
+    for prefix in ["fort.38-eh", "fort.38-ph"]:
+        names = [f for f in os.listdir(".") if f.startswith(prefix) and not f.endswith(".err")]
+        tables += sorted(names, key=lambda x: float(x[len(prefix):]))
+    return tables
+
+
+def redox_residues(fname="head3.lst"):
+    """Residues, named as in charged_fractions, with conformers that take electrons in fname, None without fname."""
+    if not os.path.isfile(fname):
+        return None
+    residues = set()
+    for line in open(fname).readlines()[1:]:
+        fields = line.split()
+        if len(fields) > 8 and int(fields[7]) != 0:
+            residues.add(fields[1][:3] + fields[1][5:11])
+    return residues
+
+
+def fit_grid(tables, fname="pK.grid"):
+    """Fit every table of a grid titration to its pK.out, and write pKa at every Eh and Em at every pH of all
+    ionizable residues to fname. Eh titrations fit only redox residues of head3.lst, the other cells are blank."""
+    redox = redox_residues()
+    if redox is None:
+        print("head3.lst not found, fitting Em of all ionizable residues")
+    columns = []
+    values = {}
+    for table in tables:
+        titration_type, points, confnames, occ = read_occupancy(table)
+        if len(points) < 2:
+            continue
+        if titration_type == "eh" and redox is not None:
+            keep = [i for i in range(len(confnames)) if confnames[i][:3] + confnames[i][5:11] in redox]
+            confnames = [confnames[i] for i in keep]
+            occ = occ[keep]
+        names, x0, n, residuals, bound = fit_pka(titration_type, points, confnames, occ)
+        write_pkout(titration_type, names, x0, n, residuals, bound, fname=pkout_name(table))
+        if titration_type == "ph":
+            column = "pKa@eh" + table[len("fort.38-eh"):]
+        else:
+            column = "Em@ph" + table[len("fort.38-ph"):]
+        columns.append(column)
+        for i in range(len(names)):
+            values.setdefault(names[i], {})[column] = bound[i] or "%.3f" % x0[i]
+        print("Fitted %d of %d ionizable residues from %s to %s" % (np.sum(bound == ""), len(names), table,
+                                                                   pkout_name(table)))
+
+    width = max([len(x) for x in columns] + [9])
+    lines = ["%-14s" % "grid" + "".join([" %*s" % (width, x) for x in columns]) + "\n"]
+    for name in values:
+        lines.append("%-14s" % name + "".join([" %*s" % (width, values[name].get(x, "")) for x in columns]) + "\n")
+    open(fname, "w").writelines(lines)
+    print("pKa at every Eh and Em at every pH written to %s" % fname)
+    return
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit titration curves")
+    parser.add_argument("table", nargs="?", default="fort.38", help="occupancy table to fit, default fort.38")
+    args = parser.parse_args()
+
     # compose file names to read
     folder = "microstates"
-    files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and f.endswith("-accessibles")]
-
-    ph_range, eh_range = titration_range(files)
-    if len(ph_range) > 1 and len(eh_range) == 1:
-        titration_type = "ph"
-        points = ph_range
-    elif len(ph_range) == 1 and len(eh_range) > 1:
-        titration_type = "eh"
-        points = eh_range
-    elif len(ph_range) == 1 and len(eh_range) == 1:
-        titration_type = "single"
-    else:
-        titration_type = "multi"
+    files = []
+    if os.path.isdir(folder):
+        files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and
+                 f.endswith("-accessibles")]
 
     for fn in files:
         print("Computing analytical recovered counts)")
-        recover_counts(fn)
-
-    ph_range_str = ", ".join(["%.1f" %x for x in ph_range])
-    eh_range_str = ", ".join(["%.0f" %x for x in eh_range])
-    print("Titration type is \"%s\" at pH [%s] and eh [%s]" % (titration_type, ph_range_str, eh_range_str))
-    if titration_type == "multi":
-        print("Skipping curve fitting")
-        sys.exit()
+        recover_counts(os.path.join(folder, fn))
 
+    # titration type and points come from the occupancy table, microstates may not have been written or collected
+    if os.path.isfile(args.table):
+        titration_type, points, confnames, occ = read_occupancy(args.table)
+        print("Titration type is \"%s\" at %s" % (titration_type, ", ".join(["%g" % x for x in points])))
+        if len(points) < 2:
+            print("Occupancy table %s has one titration point, skipping curve fitting" % args.table)
+            sys.exit()
+        names, x0, n, residuals, bound = fit_pka(titration_type, points, confnames, occ)
+        write_pkout(titration_type, names, x0, n, residuals, bound, fname=pkout_name(args.table))
+        print("Fitted %d of %d ionizable residues from %s to %s" % (np.sum(bound == ""), len(names), args.table,
+                                                                   pkout_name(args.table)))
+    elif grid_tables():
+        print("Titration type is \"multi\", a pH x Eh grid")
+        fit_grid(grid_tables())
+    else:
+        print("No occupancy table %s or fort.38-eh*/fort.38-ph* tables, skipping curve fitting" % args.table)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Binary microstate trajectory, a compact alternative to the ms.gz text format.
+
+File microstates/ph##.#-eh#-run##.msb.gz is compressed by the codec of its suffix, see mscodec.py. It starts with a
+text header:
+    PYMCCE MSB 2
+    T=298.150000, ph=7.000000, eh=0.000000
+    steps=40000, conf=<u2
+    -24.525: initial state
+and is followed by blocks of accepted steps, each a block header and then the columns of its records:
+    records  uint32               number of records, one per accepted step
+    confs    uint32               conformers switched off by all records, the same number is switched on
+    skip     uint8                bytes of a skip value, 1, 2 or 4, and so on for dE, n and shift
+    dE       uint8
+    n        uint8
+    shift    uint8
+    skip     uint x records       number of rejected steps before each step
+    dE       int x records        energy after each step minus the one before, in 0.001 kcal/mol
+    n        uint x records       number of conformers switched off by each step
+    off      conf x confs         conformers switched off, in order within a step, the steps in turn
+    shift    int x confs          conformer switched on minus the one switched off at the same place
+Records hold only the conformers their steps flip, and conformers switched on are mostly next to the ones switched
+off in the same residue, so the columns are small integers. Energies have the 3 decimals of the text format.
+Rejected steps after the last record are the total steps minus the steps covered by records. When the number of
+steps is not known in advance, steps=0 and the file ends with a record of n=0 carrying the rejected steps after the
+last accepted step.
+"""
+
+import numpy as np
+from mscodec import codec_open, ms_open
+
+MSB_MAGIC = "PYMCCE MSB 2"
+CHUNK_RECORDS = 65536
+BLOCK_HEADER = np.dtype([("records", "<u4"), ("confs", "<u4"), ("skip", "u1"), ("dE", "u1"), ("n", "u1"),
+                         ("shift", "u1")])
+
+
+def int_bytes(values, signed=False):
+    """Bytes of the smallest integer type, 1, 2, 4 or 8, that holds values."""
+    if len(values) == 0:
+        return 1
+    low = min(values)
+    high = max(values)
+    for nbytes in (1, 2, 4):
+        if signed and -2 ** (8 * nbytes - 1) <= low and high < 2 ** (8 * nbytes - 1):
+            return nbytes
+        elif not signed and high < 2 ** (8 * nbytes):
+            return nbytes
+    return 8
+
+
+def int_dtype(nbytes, signed=False):
+    return np.dtype("<%s%d" % ("i" if signed else "u", nbytes))
+
+
+def milli(E):
+    """Energy in 0.001 kcal/mol, as written by the text format."""
+    return int(round(E * 1000.0))
+
+
+class MSB_Writer:
+    """Buffered writer of one binary MC run."""
+
+    def __init__(self, fname, T, ph, eh, E, state, steps, n_conf, codec="gzip", level=None):
+        self.conf = np.dtype("<u2" if n_conf < 65536 else "<i4")
+        self.fh = codec_open(fname, "wb", codec, level)
+        lines = [MSB_MAGIC + "\n",
+                 "T=%f, ph=%f, eh=%f\n" % (T, ph, eh),
+                 "steps=%d, conf=%s\n" % (steps, self.conf.str),
+                 "%.3f: %s\n" % (E, ",".join(["%d" % x for x in state]))]
+        self.fh.write("".join(lines).encode())
+        self.steps = steps
+        self.E = milli(float("%.3f" % E))
+        self.skip = 0
+        self.skips = []
+        self.dEs = []
+        self.ns = []
+        self.offs = []
+        self.shifts = []
+        return
+
+    def accept(self, E, off_confs, on_confs):
+        E = milli(E)
+        self.skips.append(self.skip)
+        self.dEs.append(E - self.E)
+        self.ns.append(len(off_confs))
+        off_confs = sorted(off_confs)
+        self.offs.extend(off_confs)
+        self.shifts.extend([on - off for on, off in zip(sorted(on_confs), off_confs)])
+        self.E = E
+        self.skip = 0
+        if len(self.skips) >= CHUNK_RECORDS:
+            self.flush()
+        return
+
+    def reject(self, n=1):
+        self.skip += n
+        return
+
+    def flush(self):
+        if self.skips:
+            columns = [(self.skips, False), (self.dEs, True), (self.ns, False), (self.shifts, True)]
+            nbytes = [int_bytes(values, signed) for values, signed in columns]
+            header = np.array([tuple([len(self.skips), len(self.offs)] + nbytes)], dtype=BLOCK_HEADER)
+            self.fh.write(header.tobytes())
+            for (values, signed), size in zip(columns[:3], nbytes[:3]):
+                self.fh.write(np.array(values, dtype=int_dtype(size, signed)).tobytes())
+            self.fh.write(np.array(self.offs, dtype=self.conf).tobytes())
+            self.fh.write(np.array(self.shifts, dtype=int_dtype(nbytes[3], True)).tobytes())
+            self.skips = []
+            self.dEs = []
+            self.ns = []
+            self.offs = []
+            self.shifts = []
+        return
+
+    def close(self):
+        if self.steps == 0 and self.skip:
+            self.skips.append(self.skip)
+            self.dEs.append(0)
+            self.ns.append(0)
+        self.flush()
+        self.fh.close()
+        return
+
+
+class MSB_Reader:
+    """Reader of one binary MC run.
+
+    Header values are attributes, records are read a block at a time by chunks().
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.fh = ms_open(fname)
+        magic = self.fh.readline().decode().strip()
+        if magic != MSB_MAGIC:
+            raise ValueError("%s is not a binary microstate file of version %s" % (fname, MSB_MAGIC.split()[-1]))
+
+        self.mc_parm = {}
+        for field in self.fh.readline().decode().strip().split(","):
+            key, value = field.split("=")
+            self.mc_parm[key.strip()] = float(value)
+
+        fmt = {}
+        for field in self.fh.readline().decode().strip().split(","):
+            key, value = field.split("=")
+            fmt[key.strip()] = value.strip()
+        self.steps = int(fmt["steps"])
+        self.conf = np.dtype(fmt["conf"])
+
+        E_str, state_str = self.fh.readline().decode().split(":")
+        self.E = float(E_str)
+        self.state = np.array([int(ic) for ic in state_str.split(",")])
+
+        if self.steps == 0:
+            for skip, E, n, off, on in self.chunks():
+                self.steps += len(n) + int(skip.sum()) - int((n == 0).sum())
+            # reopen rather than seek, not every codec can seek back
+            self.fh.close()
+            self.fh = ms_open(fname)
+            for i in range(4):
+                self.fh.readline()
+        return
+
+    def read(self, dtype, count):
+        buf = self.fh.read(dtype.itemsize * count)
+        if len(buf) != dtype.itemsize * count:
+            raise ValueError("Truncated block in binary microstate file %s" % self.fname)
+        return np.frombuffer(buf, dtype=dtype)
+
+    def chunks(self):
+        """Yield the blocks of records as arrays skip, E, n, off and on. off and on hold the conformers of all the
+        records of a block in turn, n of them for each record."""
+        E = milli(self.E)
+        while True:
+            buf = self.fh.read(BLOCK_HEADER.itemsize)
+            if not buf:
+                break
+            if len(buf) != BLOCK_HEADER.itemsize:
+                raise ValueError("Truncated block in binary microstate file %s" % self.fname)
+            header = np.frombuffer(buf, dtype=BLOCK_HEADER)[0]
+            records = int(header["records"])
+            confs = int(header["confs"])
+            skip = self.read(int_dtype(header["skip"]), records)
+            dE = self.read(int_dtype(header["dE"], True), records)
+            n = self.read(int_dtype(header["n"]), records)
+            off = self.read(self.conf, confs)
+            shift = self.read(int_dtype(header["shift"], True), confs)
+            Es = E + np.cumsum(dE, dtype=np.int64)
+            if records:
+                E = int(Es[-1])
+            yield skip, Es / 1000.0, n, off, off.astype(np.int64) + shift
+        return
+
+    def close(self):
+        self.fh.close()
+        return
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Compression codecs of microstate files, selected by (MONTE_CODEC) as "codec" or "codec:level":
+    gzip    .gz, level 1-9, default 9
+    zlib    .zz, level 1-9, default 6
+    lzma    .xz, preset 0-9, default 6
+    none    no suffix, uncompressed
+The suffix after .ms or .msb tells readers the codec of a file.
+"""
+
+import io
+import os
+import gzip
+import lzma
+import zlib
+
+CODEC_SUFFIX = {"gzip": ".gz", "zlib": ".zz", "lzma": ".xz", "none": ""}
+CODEC_LEVEL = {"gzip": 9, "zlib": 6, "lzma": 6, "none": 0}
+BUFFER_SIZE = 1 << 20
+
+
+def parse_codec(spec):
+    """Codec name and level of a "codec" or "codec:level" string."""
+    fields = spec.lower().split(":")
+    name = fields[0].strip()
+    if name not in CODEC_SUFFIX:
+        raise ValueError("Unknown microstate codec %s, it has to be one of %s" % (name, ", ".join(CODEC_SUFFIX)))
+    if len(fields) > 1 and fields[1].strip():
+        level = int(fields[1])
+    else:
+        level = CODEC_LEVEL[name]
+    return name, level
+
+
+def file_codec(fname):
+    """Codec of a microstate file from its suffix."""
+    ext = os.path.splitext(fname)[1]
+    for name in CODEC_SUFFIX:
+        if CODEC_SUFFIX[name] and ext == CODEC_SUFFIX[name]:
+            return name
+    return "none"
+
+
+def is_microstate_file(fname):
+    """True for ms and msb files in any codec."""
+    name = fname
+    if file_codec(fname) != "none":
+        name = os.path.splitext(fname)[0]
+    return name.endswith(".ms") or name.endswith(".msb")
+
+
+def codec_open(fname, mode="rb", codec="gzip", level=None):
+    """Open a binary file object of fname, compressed by codec at level when writing."""
+    if level is None:
+        level = CODEC_LEVEL[codec]
+    if codec == "gzip":
+        return gzip.open(fname, mode, compresslevel=level)
+    elif codec == "lzma":
+        if "w" in mode:
+            return lzma.open(fname, mode, preset=level)
+        return lzma.open(fname, mode)
+    elif codec == "zlib":
+        if "w" in mode:
+            return io.BufferedWriter(ZlibFile(fname, mode, level), BUFFER_SIZE)
+        return io.BufferedReader(ZlibFile(fname, mode), BUFFER_SIZE)
+    else:
+        return open(fname, mode, buffering=BUFFER_SIZE)
+
+
+def ms_open(fname):
+    """Open a microstate file for reading in the codec of its suffix."""
+    return codec_open(fname, "rb", file_codec(fname))
+
+
+class ZlibFile(io.RawIOBase):
+    """Raw file of one zlib stream, zlib has no file object of its own."""
+
+    def __init__(self, fname, mode="rb", level=6):
+        self.fh = open(fname, mode)
+        self.writing = "w" in mode
+        if self.writing:
+            self.z = zlib.compressobj(level)
+        else:
+            self.z = zlib.decompressobj()
+        self.buf = b""
+        self.eof = False
+        return
+
+    def readable(self):
+        return not self.writing
+
+    def writable(self):
+        return self.writing
+
+    def readinto(self, b):
+        while not self.buf and not self.eof:
+            data = self.fh.read(BUFFER_SIZE)
+            if data:
+                self.buf = self.z.decompress(data)
+            else:
+                self.buf = self.z.flush()
+                self.eof = True
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def write(self, b):
+        self.fh.write(self.z.compress(bytes(b)))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            if self.writing:
+                self.fh.write(self.z.flush())
+            self.fh.close()
+        super().close()
+        return
@@ -5,12 +5,18 @@ import os
 import numpy as np
 import shutil
 import random
-import gzip
 import math
+import time
+from msbinary import MSB_Writer
+from mscodec import CODEC_SUFFIX, parse_codec, codec_open
 
 Delta_PW_warning = 0.1
+CACHE_VERSION = "2"  # changes when the cached arrays of MC_Protein change
+CONFORMER_FIELDS = ["iConf", "confname", "flag", "on", "occ", "crg", "em0", "pk0", "ne", "nh", "vdw0", "vdw1", "tors",
+                    "epol", "dsolv", "extra", "history"]
 ROOMT = 298.15
 PH2KCAL = 1.364
+PH2MV = 58.0  # 1 pH unit in mV, also in fitpka.py
 KCAL2KT = 1.688
 KJ2KCAL = 0.239
 
@@ -24,6 +30,7 @@ class Env:
         self.fn_conflist3 = "head3.lst"
         self.energy_table = "energies"
         self.mc_states = "microstates"
+        self.mc_cache = "mc_cache"
         self.prm = self.load_runprm()
         self.tpl = {}
         self.read_extra()
@@ -31,9 +38,12 @@ class Env:
 
     def load_runprm(self):
         float_values = ["EPSILON_PROT", "TITR_PH0", "TITR_PHD", "TITR_EH0", "TITR_EHD", "CLASH_DISTANCE",
-                        "BIG_PAIRWISE", "MONTE_T", "MONTE_REDUCE"]
+                        "BIG_PAIRWISE", "MONTE_T", "MONTE_REDUCE", "MONTE_RHAT", "MONTE_DISCARD",
+                        "MONTE_DISCARD_WARM"]
         int_values = ["TITR_STEPS", "MONTE_RUNS", "MONTE_TRACE", "MONTE_NITER", "MONTE_NEQ",
-                      "MONTE_NSTART", "MONTE_FLIPS", "NSTATE_MAX", "MONTE_NEQ"]
+                      "MONTE_NSTART", "MONTE_FLIPS", "NSTATE_MAX", "MONTE_WORKERS", "MONTE_SEED",
+                      "MONTE_WALKERS", "MONTE_SWAP", "MONTE_NEQ_WARM",
+                      "MONTE_CHECK", "TITR_EH_STEPS"]
         prm = {}
         print("   Loading %s" % self.runprm)
         lines = open(self.runprm).readlines()
@@ -175,9 +185,6 @@ class Conformer:
         self.dsolv = float(fields[13]) * env.tpl[("SCALING", "DSOLV")]
         self.extra = float(fields[14])
         self.history = fields[15]
-        # needed by MC process
-        self.E_self = 0.0  # self energy in head3.lst
-        self.E_self_mfe = 0.0  # self energy including pairwise contribution from fixed residues
         return
 
     def printme(self):
@@ -204,12 +211,102 @@ class MC_Protein:
 
     def __init__(self):
         print("\n   Reading and interpreting input energy and conformer list.")
-        self.head3list, self.confnames = self.read_head3list()
-        self.pairwise = self.read_pairwise()
-        self.fixed_conformers, self.free_residues, self.biglist = self.group_conformers()
+        cache = env.prm.get("MONTE_CACHE", "f").lower() == "t"
+        key = self.cache_key() if cache else None
+        if cache and self.load_cache(key):
+            print("      Loaded conformers and pairwise interactions from %s" % env.mc_cache)
+        else:
+            self.head3list, self.confnames = self.read_head3list()
+            self.fixed_conformers, self.free_residues = self.group_conformers()
+            self.make_arrays()
+            self.free_conformers, self.free_index = self.index_free_conformers()
+            self.conf_residue, self.conf_slot = self.index_residues()
+            self.pairwise, self.free_pairwise, self.mfe, self.fixed_pw = self.read_pairwise()
+            self.residue_pw = self.residue_pairwise()
+            self.biglist = self.make_biglist()
+            if cache:
+                self.save_cache(key)
         self.report_residues()
         return
 
+    def cache_key(self):
+        """Hash of head3.lst, the opp files, scaling factors and the run.prm entries that shape MC_Protein."""
+        import hashlib
+        h = hashlib.sha256()
+        h.update(CACHE_VERSION.encode())
+        h.update(open(env.fn_conflist3, "rb").read())
+        if os.path.isdir(env.energy_table):
+            for fname in sorted(os.listdir(env.energy_table)):
+                if fname.endswith(".opp"):
+                    h.update(fname.encode())
+                    h.update(open(os.path.join(env.energy_table, fname), "rb").read())
+        settings = sorted([(",".join(key), value) for key, value in env.tpl.items() if key[0] == "SCALING"])
+        settings += [(key, env.prm.get(key)) for key in ["PAIRWISE_COMPACT", "BIG_PAIRWISE"]]
+        h.update(repr(settings).encode())
+        return h.hexdigest()
+
+    def save_cache(self, key):
+        """Write the arrays of MC_Protein as .npy files in (env.mc_cache), the key file last. The full pairwise
+        matrix is left out, only the free-free block, mfe and fixed_pw are used after loading."""
+        folder = env.mc_cache
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.mkdir(folder)
+        arrays = {"confnames": np.array(self.confnames),
+                  "fixed_conformers": np.array(self.fixed_conformers, dtype=int),
+                  "free_conformers": np.array(self.free_conformers, dtype=int),
+                  "free_index": np.array(self.free_index, dtype=int),
+                  "conf_residue": self.conf_residue,
+                  "conf_slot": self.conf_slot,
+                  "free_pairwise": self.free_pairwise,
+                  "mfe": self.mfe,
+                  "fixed_pw": np.array(self.fixed_pw),
+                  "residue_pw": self.residue_pw}
+        for field in CONFORMER_FIELDS:
+            arrays["conf_" + field] = np.array([getattr(conf, field) for conf in self.head3list])
+        for name, lists in [("free_residues", self.free_residues), ("residues", self.residues),
+                            ("biglist", self.biglist)]:
+            arrays[name], arrays[name + "_size"] = pack_lists(lists)
+        for name in arrays:
+            np.save(os.path.join(folder, name + ".npy"), arrays[name])
+        open(os.path.join(folder, "key"), "w").write(key + "\n")
+        return
+
+    def load_cache(self, key):
+        """Load MC_Protein from (env.mc_cache) if it was saved under key, large arrays are memory mapped."""
+        folder = env.mc_cache
+        fname = os.path.join(folder, "key")
+        if not os.path.isfile(fname) or open(fname).read().strip() != key:
+            return False
+
+        def load(name):
+            # plain arrays on the mapped file, memmap objects are slow to index one item at a time
+            return np.asarray(np.load(os.path.join(folder, name + ".npy"), mmap_mode="r"))
+
+        conf_fields = dict([(field, load("conf_" + field).tolist()) for field in CONFORMER_FIELDS])
+        self.head3list = []
+        for i in range(len(conf_fields["confname"])):
+            conf = Conformer.__new__(Conformer)
+            for field in CONFORMER_FIELDS:
+                setattr(conf, field, conf_fields[field][i])
+            self.head3list.append(conf)
+        self.confnames = load("confnames").tolist()
+        self.fixed_conformers = load("fixed_conformers").tolist()
+        self.free_residues = unpack_lists(load("free_residues"), load("free_residues_size"))
+        self.residues = unpack_lists(load("residues"), load("residues_size"))
+        self.make_arrays()
+        self.free_conformers = load("free_conformers").tolist()
+        self.free_index = load("free_index").tolist()
+        self.conf_residue = np.array(load("conf_residue"))
+        self.conf_slot = np.array(load("conf_slot"))
+        self.pairwise = None  # the full matrix is not used by MC and energy routines and is not cached
+        self.free_pairwise = load("free_pairwise")
+        self.mfe = np.array(load("mfe"))
+        self.fixed_pw = float(load("fixed_pw"))
+        self.residue_pw = load("residue_pw")
+        self.biglist = unpack_lists(load("biglist"), load("biglist_size"))
+        return True
+
     def read_head3list(self):
         head3list = []
         fname = env.fn_conflist3
@@ -229,14 +326,16 @@ class MC_Protein:
 
         # validate
         confnames = [x.confname for x in head3list]
+        seen = set()
         for name in confnames:
             if len(name) != 14:
-                print("      ERROR: %s is not a conformer name.")
+                print("      ERROR: %s is not a conformer name." % name)
                 sys.exit()
-            occurrence = confnames.count(name)
-            if occurrence > 1:
+            if name in seen:
+                occurrence = confnames.count(name)
                 print("      ERROR: Conformer %s occurred %d times" % (name, occurrence))
                 sys.exit()
+            seen.add(name)
         return head3list, confnames
 
     def print_headlist(self):
@@ -259,64 +358,149 @@ class MC_Protein:
                                                                                                        conf.history))
         return
 
-    def read_pairwise(self):
-        """Read pairwise interactions from opp files in folder."""
+    def read_pairwise(self, ele=None, vdw=None, terms=False):
+        """Read pairwise interactions from opp files in folder, ele and vdw scaled by ele and vdw, by default the
+        SCALING factors.
+
+        MC and energy routines only use the free-free block of pairwise, and the interactions with fixed conformers
+        folded into a mfe vector over all conformers and the fixed-fixed pairwise sum. With (PAIRWISE_COMPACT) the
+        full matrix is never made, the free-free block is float32 and the returned full pairwise is None.
+
+        With terms, unscaled ele and vdw are read in one pass and returned apart, as free-free block, mfe and fixed
+        pairwise sum with a leading (ele, vdw) axis. The full matrix is not made and asymmetry is not reported.
+        """
+        if ele is None:
+            ele = env.tpl[("SCALING", "ELE")]
+        if vdw is None:
+            vdw = env.tpl[("SCALING", "VDW")]
         folder = env.energy_table
         print("      Loading pairwise interactions from opp files in folder %s ..." % folder)
         n_size = len(self.confnames)
-        pairwise = np.zeros((n_size, n_size))
+        conf_index = {}
         for i in range(n_size):
-            conf = self.head3list[i]
-            oppfile = "%s/%s.opp" % (folder, conf.confname)
-            resid_i = conf.confname[:3] + conf.confname[5:11]
-            if os.path.isfile(oppfile):
-                lines = open(oppfile)
-                for line in lines:
-                    fields = line.split()
-                    if len(fields) < 6:
-                        continue
-                    confname = fields[1]
-                    j = self.confnames.index(confname)
-                    if j < 0:
-                        print("      Warning: %s in file %s is not a conformer" % (confname, oppfile))
-                        continue
-
-                    resid_j = confname[:3] + confname[5:11]
-                    if resid_i != resid_j:  # not within a residue
-                        ele = float(fields[2])
-                        vdw = float(fields[3])
-                        pw = ele * env.tpl[("SCALING", "ELE")] + vdw * env.tpl[("SCALING", "VDW")]
-                        pairwise[i][j] = pw
+            conf_index[self.confnames[i]] = i
+        resids = {}
+        resid_of = np.array([resids.setdefault(x[:3] + x[5:11], len(resids)) for x in self.confnames])
+
+        compact = env.prm.get("PAIRWISE_COMPACT", "f").lower() == "t"
+        dtype = np.float32 if compact else float
+        if terms:
+            scales = [(1.0, 0.0), (0.0, 1.0)]
+            compact = True
+        else:
+            scales = [(ele, vdw)]
+        free = np.array(self.free_conformers, dtype=int)
+        fixed = np.array(self.fixed_conformers, dtype=int)
+        free_index = np.array(self.free_index)
+        fixed_occ = np.zeros(n_size)
+        fixed_occ[fixed] = self.occ[fixed]
+
+        if compact:
+            pairwise = None
+            free_pairwise = np.zeros((len(scales), len(free), len(free)), dtype=dtype)
+            mfe = np.zeros((len(scales), n_size))
+            fixed_pw = np.zeros(len(scales))
+        else:
+            pairwise = np.zeros((n_size, n_size))
+
+        oppfiles = ["%s/%s.opp" % (folder, confname) for confname in self.confnames]
+        workers = env.prm.get("MONTE_WORKERS", 1)
+        if workers > 1:
+            import multiprocessing
+            pool = multiprocessing.get_context("fork").Pool(workers)
+            opps = pool.imap(read_opp, oppfiles, chunksize=16)
+        else:
+            pool = None
+            opps = map(read_opp, oppfiles)
+
+        for i, (confnames, ele_pw, vdw_pw) in enumerate(opps):
+            js = []
+            for confname in confnames:
+                j = conf_index.get(confname, -1)
+                if j < 0:
+                    print("      Warning: %s in file %s is not a conformer" % (confname, oppfiles[i]))
+                js.append(j)
+            js = np.array(js, dtype=int)
+            ele_pw = np.array(ele_pw)
+            vdw_pw = np.array(vdw_pw)
+            pw = np.array([ele_pw * e + vdw_pw * v for e, v in scales]).reshape(len(scales), len(js))
+            keep = js >= 0
+            js = js[keep]
+            pw = pw[:, keep]
+            keep = resid_of[js] != resid_of[i]  # not within a residue
+            js = js[keep]
+            pw = pw[:, keep]
+
+            if not compact:
+                pairwise[i, js] = pw[0]
+                continue
+
+            # a repeated conformer overwrites the earlier one, as in the full matrix
+            js, last = np.unique(js[::-1], return_index=True)
+            pw = pw[:, ::-1][:, last]
+            if free_index[i] >= 0:
+                keep = free_index[js] >= 0
+                free_pairwise[:, free_index[i], free_index[js[keep]]] = pw[:, keep]
+            # pairwise is the average of the two opp files, each file brings half
+            pw_fixed = pw * fixed_occ[js]
+            mfe[:, i] += pw_fixed.sum(axis=1) / 2
+            mfe[:, js] += pw * fixed_occ[i] / 2
+            fixed_pw += fixed_occ[i] * pw_fixed.sum(axis=1) / 2
+
+        if pool:
+            pool.close()
+            pool.join()
 
         # Average pairwise after loading
-        for i in range(n_size - 1):
-            for j in range(i + 1, n_size):
-                pw1 = pairwise[i][j]
-                pw2 = pairwise[j][i]
-                if abs(pw1 - pw2) > Delta_PW_warning:
-                    print("         Warning: big pairwise difference between %s: %.3f and %s: %.3f" % (
-                        self.confnames[i],
-                        pw1,
-                        self.confnames[j],
-                        pw2))
-                pairwise[i][j] = pairwise[j][i] = (pw1 + pw2) / 2
-
-        return pairwise
+        if terms:
+            return (free_pairwise + free_pairwise.transpose(0, 2, 1)) / 2, mfe, fixed_pw
+        elif compact:
+            self.report_asymmetry(free_pairwise[0], [self.confnames[ic] for ic in self.free_conformers])
+            free_pairwise = (free_pairwise[0] + free_pairwise[0].T) / 2
+            mfe = mfe[0]
+            fixed_pw = fixed_pw[0]
+        else:
+            self.report_asymmetry(pairwise, self.confnames)
+            pairwise = (pairwise + pairwise.T) / 2
+            free_pairwise = pairwise[np.ix_(free, free)]
+            mfe = np.dot(pairwise[:, fixed], fixed_occ[fixed])
+            fixed_pw = np.dot(fixed_occ[fixed], np.dot(np.triu(pairwise[np.ix_(fixed, fixed)], 1), fixed_occ[fixed]))
+
+        return pairwise, free_pairwise, mfe, float(fixed_pw)
+
+    def report_asymmetry(self, pairwise, confnames):
+        """Summarize conformer pairs whose two pairwise values differ by more than Delta_PW_warning."""
+        fname = "pairwise_asymmetry.info"
+        ic, jc = np.nonzero(np.triu(np.abs(pairwise - pairwise.T) > Delta_PW_warning, 1))
+        if len(ic) == 0:
+            if os.path.isfile(fname):
+                os.remove(fname)
+            return
+
+        lines = ["CONFORMER_i    CONFORMER_j     pw_ij   pw_ji\n"]
+        for i, j in zip(ic.tolist(), jc.tolist()):
+            lines.append("%s %s %7.3f %7.3f\n" % (confnames[i], confnames[j],
+                                                  pairwise[i, j], pairwise[j, i]))
+        open(fname, "w").writelines(lines)
+
+        k = np.argmax(np.abs(pairwise[ic, jc] - pairwise[jc, ic]))
+        i, j = ic[k], jc[k]
+        print("         Warning: %d big pairwise differences, listed in %s. Biggest between %s: %.3f and %s: %.3f" % (
+            len(ic), fname, confnames[i], pairwise[i, j], confnames[j], pairwise[j, i]))
+        return
 
     def group_conformers(self):
         fixed_conformers = []
         free_residues = []
-        residue_ids = []
-        for confname in self.confnames:
-            resid = confname[:3] + confname[5:11]
-            if resid not in residue_ids:
-                residue_ids.append(resid)
-        self.residues = [[] for i in range(len(residue_ids))]  # residue stores indices to conformers
+        residue_ids = {}
+        self.residues = []  # residue stores indices to conformers
         for i in range(len(self.confnames)):
             confname = self.confnames[i]
             resid = confname[:3] + confname[5:11]
-            index = residue_ids.index(resid)
-            self.residues[index].append(i)
+            if resid not in residue_ids:
+                residue_ids[resid] = len(self.residues)
+                self.residues.append([])
+            self.residues[residue_ids[resid]].append(i)
 
         # Verify head3list flag and occ; Find free and fixed residues
         # if total occ of "t" flagged conformers is 1:
@@ -387,42 +571,99 @@ class MC_Protein:
                 print("      Exiting ...")
                 sys.exit()
 
+        return fixed_conformers, free_residues
+
+    def index_free_conformers(self):
+        """Free conformers in free residue order, and the index of every conformer in them, -1 if not free."""
+        free_conformers = []
+        for res in self.free_residues:
+            free_conformers += res
+        free_index = [-1] * len(self.head3list)
+        for i in range(len(free_conformers)):
+            free_index[free_conformers[i]] = i
+        return free_conformers, free_index
+
+    def index_residues(self):
+        """Free residue of every conformer and its place in the residue, -1 for fixed conformers."""
+        conf_residue = np.full(len(self.head3list), -1, dtype=int)
+        conf_slot = np.full(len(self.head3list), -1, dtype=int)
+        for ir in range(len(self.free_residues)):
+            conf_residue[self.free_residues[ir]] = ir
+            conf_slot[self.free_residues[ir]] = np.arange(len(self.free_residues[ir]))
+        return conf_residue, conf_slot
+
+    def residue_pairwise(self):
+        """Largest absolute pairwise interaction between every two free residues, reduced from the free-free block
+        over the conformer segments of the residues."""
+        if not self.free_residues:
+            return np.zeros((0, 0))
+        starts = np.cumsum([0] + [len(res) for res in self.free_residues[:-1]])
+        pw = np.abs(self.free_pairwise)
+        residue_pw = np.maximum.reduceat(np.maximum.reduceat(pw, starts, axis=0), starts, axis=1)
+        np.fill_diagonal(residue_pw, 0.0)
+        return residue_pw
+
+    def make_biglist(self):
         # Make big list. A big list is the size of free residues. It contains other free residue index numbers that
         # have big interactions
-        bigpw = env.prm["BIG_PAIRWISE"]
-        biglist = [[] for i in range(len(free_residues))]
-        for ir in range(len(free_residues)):
-            for jr in range(ir + 1, len(free_residues)):
-                next_jr = False
-                for ic in free_residues[ir]:
-                    if next_jr:
-                        break
-                    for jc in free_residues[jr]:
-                        if next_jr:
-                            break
-                        pw = self.pairwise[ic][jc]
-                        if abs(pw) >bigpw:
-                            biglist[ir].append(jr)
-                            biglist[jr].append(ir)
-                            next_jr = True
-
-        return fixed_conformers, free_residues, biglist
+        big = self.residue_pw > env.prm["BIG_PAIRWISE"]
+        return [np.nonzero(row)[0].tolist() for row in big]
+
+    def make_arrays(self):
+        """Conformer attributes needed by MC as arrays over conformers, after grouping has settled occ."""
+        self.occ = np.array([conf.occ for conf in self.head3list])
+        self.crg = np.array([conf.crg for conf in self.head3list])
+        self.em0 = np.array([conf.em0 for conf in self.head3list])
+        self.pk0 = np.array([conf.pk0 for conf in self.head3list])
+        self.ne = np.array([conf.ne for conf in self.head3list])
+        self.nh = np.array([conf.nh for conf in self.head3list])
+        # pH and eh independent part of self energy in head3.lst
+        self.E_base = np.array([conf.vdw0 + conf.vdw1 + conf.epol + conf.tors + conf.dsolv + conf.extra
+                                for conf in self.head3list])
+        # self energy, and self energy including pairwise contribution from fixed residues, set by update_energy()
+        self.E_self = np.zeros(len(self.head3list))
+        self.E_self_mfe = np.zeros(len(self.head3list))
+        self.E_fixed = 0.0
+        self.energies = {}  # (T, ph, eh) to self energies and E_fixed, set by precompute_energy()
+        return
+
+    def self_energy(self, T=298.15, ph=7.0, eh=0.0):
+        """Return self energy and self energy with mfe of all conformers.
+
+        ph and eh may also be arrays of titration points, then each row of the returned arrays is one point.
+        """
+        ph = np.asarray(ph, dtype=float)[..., np.newaxis]
+        eh = np.asarray(eh, dtype=float)[..., np.newaxis]
+        E_ph = T / ROOMT * self.nh * (ph - self.pk0) * PH2KCAL
+        E_eh = T / ROOMT * self.ne * (eh - self.em0) * PH2KCAL / PH2MV
+        E_self = self.E_base + E_ph + E_eh
+        return E_self, E_self + self.mfe
 
     def update_energy(self, T=298.15, ph=7.0, eh=0.0):
-        # get self energy
-        for ic in range(len(self.head3list)):
-            conf = self.head3list[ic]
-            E_ph = T / ROOMT * conf.nh * (ph - conf.pk0) * PH2KCAL
-            E_eh = T / ROOMT * conf.ne * (eh - conf.em0) * PH2KCAL / 58.0
-            self.head3list[
-                ic].E_self = conf.vdw0 + conf.vdw1 + conf.epol + conf.tors + conf.dsolv + conf.extra + E_ph + E_eh
+        if (T, ph, eh) in self.energies:
+            self.E_self, self.E_self_mfe, self.E_fixed = self.energies[(T, ph, eh)]
+            return
+
+        # get self energy, mfe from fixed conformer is in self.mfe
+        self.E_self, self.E_self_mfe = self.self_energy(T=T, ph=ph, eh=eh)
 
-            # mfe from fixed conformer
-            mfe = 0.0
-            for jc in self.fixed_conformers:
-                mfe += self.pairwise[ic][jc] * self.head3list[jc].occ
+        # fixed conformers' share of the state energy, constant at this condition
+        self.E_fixed = self.fixed_energy(self.E_self_mfe)
+        return
+
+    def precompute_energy(self, T, conditions):
+        """Self energies of all (ph, eh) conditions at once, for update_energy() to look up."""
+        ph = [x[0] for x in conditions]
+        eh = [x[1] for x in conditions]
+        E_self, E_self_mfe = self.self_energy(T=T, ph=ph, eh=eh)
+        for i in range(len(conditions)):
+            self.energies[(T, ph[i], eh[i])] = (E_self[i], E_self_mfe[i], self.fixed_energy(E_self_mfe[i]))
+        return
 
-            self.head3list[ic].E_self_mfe = self.head3list[ic].E_self + mfe
+    def fixed_energy(self, E_self_mfe):
+        """Fixed conformers' self energy minus one side of pw fixed to fixed."""
+        fixed = self.fixed_conformers
+        return np.dot(E_self_mfe[fixed], self.occ[fixed]) - self.fixed_pw
 
     def report_biglist(self):
         fname = "biglist.info"
@@ -457,6 +698,155 @@ class MC_Protein:
         open(fname, "w").writelines(lines)
         return
 
+class MC_Scaling:
+    """Unscaled energy terms of prot, combined into prot energies for any SCALING factors by set().
+
+    Self energy terms come from head3.lst, and ele and vdw pairwise are read once as separate arrays, so scaling
+    factors can change without reading the energies folder again.
+    """
+
+    SELF_TERMS = ["VDW0", "VDW1", "TORS", "ELE", "DSOLV"]  # head3.lst columns vdw0 to dsolv
+    CONFORMER_TERMS = ["vdw0", "vdw1", "tors", "epol", "dsolv"]
+
+    def __init__(self, prot):
+        self.prot = prot
+        self.terms = self.read_self_terms()
+        print("      Loading ele and vdw pairwise as separate terms ...")
+        self.free_pairwise, self.mfe, self.fixed_pw = prot.read_pairwise(terms=True)
+        self.scaling = dict([(key, env.tpl[("SCALING", key)]) for key in ["VDW0", "VDW1", "VDW", "TORS", "ELE",
+                                                                          "DSOLV"]])
+        return
+
+    def read_self_terms(self):
+        """Unscaled self energy terms of head3.lst, an array of (conformers, SELF_TERMS)."""
+        terms = []
+        lines = open(env.fn_conflist3).readlines()
+        lines.pop(0)
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 16:
+                terms.append([float(x) for x in fields[9:14]])
+        return np.array(terms).reshape(-1, len(self.SELF_TERMS))
+
+    def set(self, scaling):
+        """Combine prot energies for scaling, a dict of SCALING factors like {"ELE": 0.5}, the others unchanged.
+
+        Self energies are reset, call prot.update_energy() before sampling.
+        """
+        prot = self.prot
+        self.scaling.update(scaling)
+        for key in self.scaling:
+            env.tpl[("SCALING", key)] = self.scaling[key]
+
+        factors = np.array([self.scaling[key] for key in self.SELF_TERMS])
+        scaled = self.terms * factors
+        for ic in range(len(prot.head3list)):
+            for i in range(len(self.CONFORMER_TERMS)):
+                setattr(prot.head3list[ic], self.CONFORMER_TERMS[i], scaled[ic, i])
+        prot.make_arrays()
+
+        ele = self.scaling["ELE"]
+        vdw = self.scaling["VDW"]
+        # the full pairwise matrix is not used by MC or energy routines and is not combined
+        prot.pairwise = None
+        prot.free_pairwise = (self.free_pairwise[0] * ele + self.free_pairwise[1] * vdw).astype(
+            self.free_pairwise.dtype)
+        prot.mfe = self.mfe[0] * ele + self.mfe[1] * vdw
+        prot.fixed_pw = float(self.fixed_pw[0] * ele + self.fixed_pw[1] * vdw)
+        prot.residue_pw = prot.residue_pairwise()
+        prot.biglist = prot.make_biglist()
+        return
+
+
+def scaling_grid(spec):
+    """Scaling vectors, dicts of SCALING factors, of every combination in spec like "ELE=0.5,1,2;DSOLV=0.8,1"."""
+    import itertools
+    keys = []
+    values = []
+    for item in spec.split(";"):
+        if not item.strip():
+            continue
+        key, value_string = item.split("=")
+        key = key.strip().upper()
+        if key not in MC_Scaling.SELF_TERMS + ["VDW"]:
+            print("   Error: %s is not a scaling factor, it has to be one of VDW0, VDW1, VDW, TORS, ELE and DSOLV" % key)
+            sys.exit()
+        keys.append(key)
+        values.append([float(x) for x in value_string.split(",")])
+    return [dict(zip(keys, vector)) for vector in itertools.product(*values)]
+
+
+def pack_lists(lists):
+    """Concatenated items and sizes of lists of integers, as arrays."""
+    sizes = np.array([len(x) for x in lists], dtype=int)
+    items = np.array([i for x in lists for i in x], dtype=int)
+    return items, sizes
+
+
+def unpack_lists(items, sizes):
+    """Lists of integers from pack_lists() arrays."""
+    items = np.asarray(items).tolist()
+    starts = np.cumsum(sizes) - sizes
+    return [items[start:start + size] for start, size in zip(starts.tolist(), np.asarray(sizes).tolist())]
+
+
+def read_opp(oppfile):
+    """Read conformer names, ele and vdw columns of an opp file. A missing file has no interactions."""
+    confnames = []
+    ele = []
+    vdw = []
+    if os.path.isfile(oppfile):
+        for line in open(oppfile):
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            confnames.append(fields[1])
+            ele.append(float(fields[2]))
+            vdw.append(float(fields[3]))
+    return confnames, ele, vdw
+
+
+def titration_conditions():
+    """Titration type, (ph, eh) of every titration point and the titrated values of (TITR_TYPE) in run.prm.
+
+    A "grid" titration has (TITR_STEPS) pH points at each of (TITR_EH_STEPS) Eh points, the titrated values are
+    the (ph, eh) conditions.
+    """
+    titration_type = env.prm["TITR_TYPE"].upper()
+    if titration_type == "GRID":
+        phs = [env.prm["TITR_PH0"] + i * env.prm["TITR_PHD"] for i in range(env.prm["TITR_STEPS"])]
+        ehs = [env.prm["TITR_EH0"] + i * env.prm["TITR_EHD"] for i in range(env.prm.get("TITR_EH_STEPS", 1))]
+        conditions = [(ph, eh) for eh in ehs for ph in phs]
+        return titration_type, conditions, conditions
+
+    init_ph = env.prm["TITR_PH0"]
+    step_ph = env.prm["TITR_PHD"]
+    init_eh = env.prm["TITR_EH0"]
+    step_eh = env.prm["TITR_EHD"]
+    steps = env.prm["TITR_STEPS"]
+
+    conditions = []
+    for i in range(steps):
+        # Set up pH and eh environment
+        if titration_type == "PH":
+            ph = init_ph + i * step_ph
+            eh = init_eh
+        elif titration_type == "EH":
+            ph = init_ph
+            eh = init_eh + i * step_eh
+        else:
+            print("   Error: Titration type is %s. It has to be ph, eh or grid in line (TITR_TYPE) in run.prm" %
+                  titration_type)
+            sys.exit()
+        conditions.append((ph, eh))
+
+    if titration_type == "PH":
+        points = [x[0] for x in conditions]
+    else:
+        points = [x[1] for x in conditions]
+    return titration_type, conditions, points
+
+
 def mc_prepdir():
     # prepare mc folder
     if os.path.exists(env.mc_states):
@@ -470,68 +860,339 @@ def mc_prepdir():
     return
 
 
-def mc_sample(prot, T=298.15, ph=7.0, eh=0.0):
-    print("   Titration at T = %.2f, ph = %5.2f and eh = %.0f mv" % (T, ph, eh))
+MS_BUFFER = 65536  # lines of a text microstate file written at a time
 
-    b = -KCAL2KT / (T / ROOMT)
-    n_free = len(prot.free_residues)
-    nflips = env.prm["MONTE_FLIPS"]
+
+class MS_Writer:
+    """Writer of one MC run in the ms text format, with the same interface as MSB_Writer.
+
+    With rle, rejected steps in a row are one line of their number, a single rejected step is an empty line either
+    way.
+    """
+
+    def __init__(self, fname, T, ph, eh, E, state, codec="gzip", level=None, rle=False):
+        self.fh = codec_open(fname, "wb", codec, level)
+        self.rle = rle
+        self.rejected = 0
+        self.lines = ["T=%f, ph=%f, eh=%f\n" % (T, ph, eh),
+                      "%.3f: %s\n" % (E, ",".join(["%d" % x for x in state]))]
+        return
+
+    def accept(self, E, off_confs, on_confs):
+        if self.rejected:
+            self.write_rejected()
+        line = "%.3f:" % E + ",".join(["-%d"%x for x in off_confs])+","+ ",".join(["%d"%x for x in on_confs])+"\n"
+        self.lines.append(line)
+        if len(self.lines) >= MS_BUFFER:
+            self.flush()
+        return
+
+    def reject(self, n=1):
+        if self.rle:
+            self.rejected += n
+        else:
+            self.lines.append("\n" * n)
+            if len(self.lines) >= MS_BUFFER:
+                self.flush()
+        return
+
+    def write_rejected(self):
+        if self.rejected == 1:
+            self.lines.append("\n")
+        else:
+            self.lines.append("%d\n" % self.rejected)
+        self.rejected = 0
+        return
+
+    def flush(self):
+        self.fh.write("".join(self.lines).encode())
+        self.lines = []
+        return
+
+    def close(self):
+        if self.rejected:
+            self.write_rejected()
+        self.flush()
+        self.fh.close()
+        return
+
+
+def open_ms_writer(prot, T, ph, eh, irun, E, state, n_steps):
+    """Open the microstate file of run irun in the format of (MONTE_FORMAT), text, binary or none.
+
+    The file is compressed by (MONTE_CODEC), and rejected steps of text files are run-length encoded when
+    (MONTE_RLE) is t.
+    """
+    fmt = env.prm.get("MONTE_FORMAT", "text").lower()
+    codec, level = parse_codec(env.prm.get("MONTE_CODEC", "gzip"))
+    if fmt == "none":
+        return MS_Discard()
+    elif fmt == "binary":
+        fname = "ph%.1f-eh%.0f-run%02d.msb%s" % (ph, eh, irun, CODEC_SUFFIX[codec])
+        return MSB_Writer(fname, T, ph, eh, E, state, n_steps, len(prot.head3list), codec, level)
+    else:
+        fname = "ph%.1f-eh%.0f-run%02d.ms%s" % (ph, eh, irun, CODEC_SUFFIX[codec])
+        rle = env.prm.get("MONTE_RLE", "f").lower() == "t"
+        return MS_Writer(fname, T, ph, eh, E, state, codec, level, rle)
+
+
+class MC_Field:
+    """Summed pairwise interaction of every free conformer with the current microstate.
+
+    dE of a flip is a lookup in the field. Flips of one proposal are kept pending, and the field is only updated
+    when the proposal is accepted.
+    """
+
+    def __init__(self, prot, state):
+        self.pairwise = prot.free_pairwise
+        self.free_index = prot.free_index
+        self.E_self_mfe = prot.E_self_mfe
+        self.field = self.pairwise[:, [self.free_index[ic] for ic in state]].sum(axis=1, dtype=float)
+        self.flips = []
+        return
+
+    def flip(self, old_conf, new_conf):
+        """Energy change of switching old_conf to new_conf on top of the pending flips."""
+        pw = self.pairwise
+        dE = self.E_self_mfe[new_conf] - self.E_self_mfe[old_conf]
+        old_conf = self.free_index[old_conf]
+        new_conf = self.free_index[new_conf]
+        dE += self.field[new_conf] - self.field[old_conf]
+        for ic, jc in self.flips:
+            dE += pw[new_conf][jc] - pw[new_conf][ic] - pw[old_conf][jc] + pw[old_conf][ic]
+        self.flips.append((old_conf, new_conf))
+        return dE
+
+    def accept(self):
+        # pairwise is symmetric, rows are cheaper than columns
+        for ic, jc in self.flips:
+            self.field += self.pairwise[jc]
+            self.field -= self.pairwise[ic]
+        self.flips = []
+        return
+
+    def reject(self):
+        self.flips = []
+        return
+
+
+def mc_sample(prot, T=298.15, ph=7.0, eh=0.0, seeds=None, states=None, n_eq=0):
+    """Independent MC runs at one condition, return the final state and the conformer occupancy of every run.
+
+    Run i starts from states[i] when states is given, see mc_run for n_eq. With (MONTE_RHAT), runs stop when they
+    converge, see mc_converge.
+    """
+    print("   Titration at T = %.2f, ph = %5.2f and eh = %.0f mv" % (T, ph, eh))
 
     # get ph and eh patched self energy
     prot.update_energy(T=T, ph=ph, eh=eh)
 
     # loop independent runs
-    n_conf = sum([len(x) for x in prot.free_residues])
     runs = env.prm["MONTE_RUNS"]
+    tolerance = env.prm.get("MONTE_RHAT", 0.0)
+    if tolerance > 0.0 and runs > 1:
+        return mc_converge(prot, T=T, ph=ph, eh=eh, seeds=seeds, states=states, n_eq=n_eq, tolerance=tolerance)
+
+    final_states = []
+    occ = []
     for i in range(runs):
-        fname = "ph%.1f-eh%.0f-run%02d.ms" % (ph, eh, i)
-        #fh = open(fname, "w")
-        fh = gzip.open("%s.gz" % fname, "wb")
+        if seeds:
+            random.seed(seeds[i])
+        state = states[i] if states else None
+        state, occ_run = mc_run(prot, T=T, ph=ph, eh=eh, irun=i, state=state, n_eq=n_eq)
+        final_states.append(state)
+        occ.append(occ_run)
+
+    return final_states, np.array(occ)
+
+
+class MS_Discard:
+    """Writer of steps that are not written, those of equilibration or of (MONTE_FORMAT) none."""
+
+    def accept(self, E, off_confs, on_confs):
+        return
+
+    def reject(self, n=1):
+        return
+
+    def close(self):
+        return
+
+
+class MS_Timer:
+    """Writer that passes steps on to fh and adds up the time fh takes."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.seconds = 0.0
+        return
+
+    def accept(self, E, off_confs, on_confs):
+        t = time.perf_counter()
+        self.fh.accept(E, off_confs, on_confs)
+        self.seconds += time.perf_counter() - t
+        return
 
-        # randomize a state
-        state = [random.choice(x) for x in prot.free_residues]
+    def reject(self, n=1):
+        t = time.perf_counter()
+        self.fh.reject(n)
+        self.seconds += time.perf_counter() - t
+        return
+
+    def close(self):
+        t = time.perf_counter()
+        self.fh.close()
+        self.seconds += time.perf_counter() - t
+        return
+
+
+def mc_run(prot, T=298.15, ph=7.0, eh=0.0, irun=0, state=None, n_eq=0):
+    """One independent MC run at the condition prot energies were last updated to, return the final state and the
+    occupancy of all conformers over the written steps that are counted, see written_steps.
+
+    The run starts from state, a list of free residue conformers, or from a random state. The first n_eq steps per
+    free conformer are an equilibration that is not written. A run from state is a warm start.
+    """
+    n_conf = sum([len(x) for x in prot.free_residues])
+    n_steps, n_skip = written_steps(n_conf, warm=bool(state))
+
+    chain = MC_Chain(prot, T, random, state)
+    chain.run(n_eq * n_conf, MS_Discard())
+    profile = env.prm.get("MONTE_PROFILE", "f").lower() == "t"
+    if profile:
+        chain.energies = np.empty(n_steps)
+    chain.reset_counters()
+    chain.reset_stats()
+    fh = open_ms_writer(prot, T, ph, eh, irun, chain.E, chain.state, n_steps)
+    if profile:
+        fh = MS_Timer(fh)
+    t = time.perf_counter()
+    chain.run(n_skip, fh)
+    chain.reset_stats()
+    chain.run(n_steps - n_skip, fh)
+    fh.close()
+    if profile:
+        mc_profiles.append(chain_profile(chain, T, ph, eh, irun, time.perf_counter() - t, fh.seconds))
+
+    return chain.state, chain.stats()[1]
+
+
+def written_steps(n_conf, warm=False):
+    """Written steps of a run and how many of them are left out of occupancy.
+
+    A cold run writes (MONTE_NITER) steps per free conformer and leaves out the first (MONTE_DISCARD) of them. A warm
+    run starts from the final state of a neighbouring titration point, so it writes only as many steps as a cold run
+    counts, plus the (MONTE_DISCARD_WARM) of its written steps that it leaves out, none by default.
+    """
+    n_steps = env.prm["MONTE_NITER"] * n_conf
+    n_count = n_steps - int(env.prm.get("MONTE_DISCARD", 0.1) * n_steps)
+    if not warm:
+        return n_steps, n_steps - n_count
+    n_steps = int(math.ceil(n_count / (1.0 - env.prm.get("MONTE_DISCARD_WARM", 0.0))))
+    return n_steps, n_steps - n_count
+
+
+class MC_Chain:
+    """One MC run at the condition prot energies were last updated to, advanced by run().
+
+    rng is the random module or a random.Random. Energy and conformer occupancy are averaged over the steps since
+    the last reset_stats(), and acceptance is counted since the last reset_counters().
+    """
 
+    def __init__(self, prot, T, rng=random, state=None):
+        self.prot = prot
+        self.b = -KCAL2KT / (T / ROOMT)
+        self.rng = rng
+        if state:
+            self.state = list(state)
+        else:
+            # randomize a state
+            self.state = [rng.choice(x) for x in prot.free_residues]
         # obtain a complete state
-        line = "T=%f, ph=%f, eh=%f\n" % (T, ph, eh)
-        fh.write(line.encode())
-        E = get_state_energy(prot, state)
-        line = "%.3f: %s\n" % (E, ",".join(["%d" % x for x in state]))
-        fh.write(line.encode())
+        self.E = get_state_energy(prot, self.state)
+        self.field = MC_Field(prot, self.state)
+        self.t = 0
+        self.energies = None  # buffer for the energy of every counted step when an array
+        self.reset_counters()
+        self.reset_stats()
+        return
 
-        # MC sampling
+    def reset_counters(self):
+        self.t_counted = self.t
+        self.n_accept = 0
+        self.n_multi = 0  # steps that flipped big list residues too
+        self.n_multi_accept = 0
+        self.n_energies = 0
+        return
 
-        for iterations in range((env.prm["MONTE_NITER"])*n_conf):
+    def reset_stats(self):
+        self.t0 = self.t
+        self.E_sum = 0.0
+        self.on_steps = [0] * len(self.prot.head3list)  # steps on before the last switch on
+        self.since = [0] * len(self.prot.head3list)  # first step of the last switch on
+        for ic in self.state:
+            self.since[ic] = self.t + 1
+        return
+
+    def stats(self):
+        """Average energy and conformer occupancy since the last reset_stats()."""
+        n = max(1, self.t - self.t0)
+        occ = np.array(self.on_steps, dtype=float)
+        for ic in self.state:
+            occ[ic] += self.t - self.since[ic] + 1
+        return self.E_sum / n, occ / n
+
+    def run(self, n_steps, fh):
+        """Make n_steps MC steps, written to fh."""
+        rng = self.rng
+        free_residues = self.prot.free_residues
+        biglist = self.prot.biglist
+        n_free = len(free_residues)
+        nflips = env.prm["MONTE_FLIPS"]
+        b = self.b
+        field = self.field
+        state = self.state
+        E = self.E
+        E_sum = self.E_sum
+        on_steps = self.on_steps
+        since = self.since
+        t = self.t
+        n_accept = self.n_accept
+        n_multi = self.n_multi
+        n_multi_accept = self.n_multi_accept
+        energies = self.energies
+        n_energies = self.n_energies
+
+        for iterations in range(n_steps):
+            t += 1
             old_state = list(state)
 
             # choose new state
-            ires = random.randrange(n_free)
-            #ires = np.random.randint(n_free)
+            ires = rng.randrange(n_free)
             while True:
-                new_conf = random.choice(prot.free_residues[ires])
+                new_conf = rng.choice(free_residues[ires])
                 if new_conf != state[ires]:
                     break
 
             old_conf = state[ires]
             state[ires] = new_conf
 
-            dE = prot.head3list[new_conf].E_self_mfe - prot.head3list[old_conf].E_self_mfe
-            for j in range(n_free):
-                dE += prot.pairwise[new_conf][state[j]] - prot.pairwise[old_conf][state[j]]
+            dE = field.flip(old_conf, new_conf)
 
             # multiflip
-            if prot.biglist[ires]:
+            multi = False
+            if biglist[ires]:
                 flip_probablity = 0.5
                 flip_counter = nflips
                 while flip_counter > 0:
-                    if random.random() < flip_probablity:
-                        iflip = random.choice(prot.biglist[ires])
+                    if rng.random() < flip_probablity:
+                        iflip = rng.choice(biglist[ires])
                         old_conf = state[iflip]
-                        new_conf = random.choice(prot.free_residues[iflip])
+                        new_conf = rng.choice(free_residues[iflip])
                         state[iflip] = new_conf
 
-                        dE += prot.head3list[new_conf].E_self_mfe - prot.head3list[old_conf].E_self_mfe
-                        for j in range(n_free):
-                            dE += prot.pairwise[new_conf][state[j]] - prot.pairwise[old_conf][state[j]]
+                        dE += field.flip(old_conf, new_conf)
+                        multi = True
 
                     flip_counter -= 1
                     flip_probablity = flip_probablity / 2.0
@@ -539,45 +1200,1048 @@ def mc_sample(prot, T=298.15, ph=7.0, eh=0.0):
             # evaluate
             if dE < 0.0:
                 flip = True
-            elif random.random() < math.exp(b*dE):
+            elif rng.random() < math.exp(b*dE):
                 flip = True
             else:
                 flip = False
 
             if flip:
+                field.accept()
                 new = set(state)
                 old = set(old_state)
                 on_confs = new - old
                 off_confs = old - new
                 E += dE
-                line = "%.3f:" % E + ",".join(["-%d"%x for x in off_confs])+","+ ",".join(["%d"%x for x in
-                                                                                          on_confs])+"\n"
-                fh.write(line.encode())
+                fh.accept(E, off_confs, on_confs)
+                for ic in off_confs:
+                    on_steps[ic] += t - since[ic]
+                for ic in on_confs:
+                    since[ic] = t
+                n_accept += 1
+                if multi:
+                    n_multi_accept += 1
             else:
+                field.reject()
                 state = old_state
-                fh.write("\n".encode())
+                fh.reject()
+            if multi:
+                n_multi += 1
+            E_sum += E
+            if energies is not None:
+                energies[n_energies] = E
+                n_energies += 1
+
+        self.state = state
+        self.E = E
+        self.E_sum = E_sum
+        self.t = t
+        self.n_accept = n_accept
+        self.n_multi = n_multi
+        self.n_multi_accept = n_multi_accept
+        self.n_energies = n_energies
+        return
+
+
+def mc_converge(prot, T=298.15, ph=7.0, eh=0.0, seeds=None, states=None, n_eq=0, tolerance=1.05):
+    """Independent MC runs at one condition advanced together until they agree, return the final states and the
+    conformer occupancy of every run.
+
+    Runs go on one iteration, n_conf steps, at a time. Every (MONTE_CHECK) iterations, by default 1/20 of
+    (MONTE_NITER), the R-hat of iteration averages of energy and free conformer occupancies over the latter half of
+    the runs is checked. Sampling stops when all are within tolerance, or at (MONTE_NITER) iterations. Occupancy
+    leaves out about the first (MONTE_DISCARD) of the iterations, or (MONTE_DISCARD_WARM) when runs start from states.
+    """
+    runs = env.prm["MONTE_RUNS"]
+    n_conf = sum([len(x) for x in prot.free_residues])
+    n_iter = env.prm["MONTE_NITER"]
+    check = env.prm.get("MONTE_CHECK", 0) or max(2, n_iter // 20)
+    if states:
+        discard = env.prm.get("MONTE_DISCARD_WARM", 0.0)
+    else:
+        discard = env.prm.get("MONTE_DISCARD", 0.1)
+    free_conformers = np.array(prot.free_conformers)
+
+    profile = env.prm.get("MONTE_PROFILE", "f").lower() == "t"
+    chains = []
+    fhs = []
+    for i in range(runs):
+        rng = random.Random(seeds[i] if seeds else None)
+        chain = MC_Chain(prot, T, rng, states[i] if states else None)
+        chain.run(n_eq * n_conf, MS_Discard())
+        if profile:
+            chain.energies = np.empty(n_iter * n_conf)
+        chain.reset_counters()
+        chains.append(chain)
+        # number of steps is not known yet
+        fh = open_ms_writer(prot, T, ph, eh, i, chain.E, chain.state, 0)
+        if profile:
+            fh = MS_Timer(fh)
+        fhs.append(fh)
+
+    blocks = MC_Blocks(check // 2)
+    occ_sum = np.zeros((runs, len(prot.head3list)))
+    seconds = [0.0] * runs
+    r = np.inf
+    for iteration in range(n_iter):
+        block = np.zeros((runs, 1 + len(free_conformers)))
+        for i in range(runs):
+            chains[i].reset_stats()
+            t = time.perf_counter()
+            chains[i].run(n_conf, fhs[i])
+            seconds[i] += time.perf_counter() - t
+            E_mean, occ = chains[i].stats()
+            block[i, 0] = E_mean
+            block[i, 1:] = occ[free_conformers]
+            occ_sum[i] += occ
+        blocks.add(block)
+        if (iteration + 1) % check == 0:
+            r = blocks.rhat()
+            blocks.forget(min(int(discard * blocks.n), blocks.n // 2))
+            if r <= tolerance:
+                break
+
+    for i in range(runs):
+        t = time.perf_counter()
+        fhs[i].close()
+        seconds[i] += time.perf_counter() - t
+        if profile:
+            mc_profiles.append(chain_profile(chains[i], T, ph, eh, i, seconds[i], fhs[i].seconds))
+    print("      Stopped at %d of %d iterations with R-hat %.3f" % (iteration + 1, n_iter, r))
+
+    # fixed conformers keep their occupancy in every iteration
+    occ = occ_sum / (iteration + 1)
+    m, s1, s2 = blocks.window(int(discard * blocks.n))
+    occ[:, free_conformers] = s1[:, 1:] / m
+    return [chain.state for chain in chains], occ
+
+
+def moments_rhat(mean, var, n):
+    """R-hat of every variable from the means and variances of n samples, arrays of (chains, variables)."""
+    W = var.mean(axis=0)
+    B = mean.var(axis=0, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = np.sqrt(((n - 1) / n * W + B) / W)
+    r[(W == 0) & (B == 0)] = 1.0
+    return r
+
+
+class MC_Blocks:
+    """Running sums of block averages, arrays of (chains, variables), and of their squares. The sums are marked every
+    interval blocks, so statistics of the blocks after a mark need no stored blocks. The interval doubles when there
+    are more than max_marks, and a window then starts up to an interval before the block asked for."""
+    max_marks = 64
+
+    def __init__(self, interval=1):
+        self.interval = max(1, interval)
+        self.n = 0
+        self.s1 = 0.0
+        self.s2 = 0.0
+        self.marks = [(0, 0.0, 0.0)]
+
+    def add(self, block):
+        self.n += 1
+        self.s1 = self.s1 + block
+        self.s2 = self.s2 + block * block
+        if self.n % self.interval == 0:
+            self.marks.append((self.n, self.s1, self.s2))
+            if len(self.marks) > self.max_marks:
+                self.interval *= 2
+                self.marks = self.marks[:1] + [x for x in self.marks[1:] if x[0] % self.interval == 0]
+
+    def window(self, start):
+        """Number, sum and sum of squares of the blocks from the last mark at or before block start."""
+        n, s1, s2 = [x for x in self.marks if x[0] <= start][-1]
+        return self.n - n, self.s1 - s1, self.s2 - s2
+
+    def forget(self, start):
+        """Drop the marks no window from block start on needs."""
+        while len(self.marks) > 1 and self.marks[1][0] <= start:
+            self.marks.pop(0)
+
+    def rhat(self):
+        """The largest R-hat over the latter half of the blocks, infinite while the half has less than two blocks."""
+        m, s1, s2 = self.window(self.n // 2)
+        if m < 2:
+            return np.inf
+        mean = s1 / m
+        var = (s2 - m * mean * mean) / (m - 1)
+        # rounding of the sums leaves small variances, and mean differences between chains, where all blocks are equal
+        tiny = 1e-12 * (1.0 + mean * mean)
+        var[var <= tiny] = 0.0
+        r = moments_rhat(mean, var, m)
+        r[(var == 0).all(axis=0) & (np.ptp(mean, axis=0) <= np.sqrt(tiny).max(axis=0))] = 1.0
+        return r.max()
+
+
+mc_profiles = []  # profile of every MC run when (MONTE_PROFILE) is t
+
+
+def chain_profile(chain, T, ph, eh, irun, seconds, io_seconds):
+    """Profile of the steps of chain since its last reset_counters(), that took seconds of which io_seconds writing."""
+    return run_profile(T, ph, eh, irun, chain.t - chain.t_counted, chain.n_accept, chain.n_multi, chain.n_multi_accept,
+                       seconds, io_seconds, autocorrelation_time(chain.energies[:chain.n_energies]))
+
+
+def run_profile(T, ph, eh, irun, steps, n_accept, n_multi, n_multi_accept, seconds, io_seconds, tau):
+    """Profile of one MC run of steps, with its acceptance counts and autocorrelation time tau."""
+    n = max(1, steps)
+    return {"T": T, "ph": ph, "eh": eh, "run": irun,
+            "steps": steps,
+            "acceptance": n_accept / n,
+            "multiflip": n_multi / n,
+            "multiflip_acceptance": n_multi_accept / max(1, n_multi),
+            "single_acceptance": (n_accept - n_multi_accept) / max(1, n - n_multi),
+            "seconds": seconds,
+            "steps_per_second": n / max(seconds, 1e-9),
+            "io_seconds": io_seconds,
+            "energy_seconds": seconds - io_seconds,
+            "autocorrelation_time": tau}
+
+
+class MC_Counters:
+    """Acceptance counts and energy sums of the K chains of MC_Walkers, for their profiles.
+
+    Energy is summed over batches of batch steps instead of kept for every step, and the autocorrelation time comes
+    from the variance of batch means, batch times about the square root of the number of batches long.
+    """
+
+    def __init__(self, K, batch, n_batches):
+        self.t = 0
+        self.batch = batch
+        self.n_accept = np.zeros(K, dtype=int)
+        self.n_multi = np.zeros(K, dtype=int)
+        self.n_multi_accept = np.zeros(K, dtype=int)
+        self.E_batches = np.zeros((n_batches, K))
+        self.E2_sum = np.zeros(K)
+        return
+
+    def add(self, accept, multi, E):
+        """Count one step of every chain."""
+        self.n_accept += accept
+        self.n_multi += multi
+        self.n_multi_accept += accept & multi
+        self.E_batches[self.t // self.batch] += E
+        self.E2_sum += E * E
+        self.t += 1
+        return
+
+    def autocorrelation_time(self):
+        """Integrated autocorrelation time of every chain in steps, 1 when it can not be estimated."""
+        n = max(1, self.t)
+        mean = self.E_batches.sum(axis=0) / n
+        var = self.E2_sum / n - mean * mean
+        n_full = self.t // self.batch
+        group = max(1, int(math.sqrt(n_full)))
+        n_group = n_full // group
+        tau = np.ones(len(var))
+        if n_group < 2:
+            return tau
+        means = self.E_batches[:n_group * group].reshape(n_group, group, -1).sum(axis=1) / (group * self.batch)
+        valid = var > 1.0e-12 * (1.0 + mean * mean)
+        tau[valid] = np.maximum(1.0, group * self.batch * means.var(axis=0, ddof=1)[valid] / var[valid])
+        return tau
+
+    def profiles(self, chains, conditions, runs, seconds, io_seconds):
+        """Profiles of chains, chain chains[i] at conditions[i] written as run runs[i] with io_seconds[i] writing.
+        The chains advanced together in seconds, every one of the K chains takes an equal share."""
+        tau = self.autocorrelation_time()
+        share = seconds / len(self.n_accept)
+        return [run_profile(T, ph, eh, irun, self.t, int(self.n_accept[k]), int(self.n_multi[k]),
+                            int(self.n_multi_accept[k]), share, io, float(tau[k]))
+                for k, (T, ph, eh), irun, io in zip(chains, conditions, runs, io_seconds)]
+
+
+def autocorrelation_time(x, c=5.0):
+    """Integrated autocorrelation time of series x in steps, with the window of Sokal, the shortest one of at
+    least c times the time within it. A constant series has a time of 1."""
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2:
+        return 1.0
+    x = x - x.mean()
+    f = np.fft.rfft(x, n=2 * n)
+    acf = np.fft.irfft(f * np.conjugate(f))[:n]
+    if acf[0] <= 0.0:
+        return 1.0
+    taus = 2.0 * np.cumsum(acf / acf[0]) - 1.0
+    window = np.arange(n) >= c * taus
+    if window.any():
+        return float(taus[np.argmax(window)])
+    return float(taus[-1])
+
+
+def write_mc_profile(fname="mc_profile.json"):
+    """Write mc_profiles to fname, sorted by condition and run, and print their averages per condition."""
+    import json
+    profiles = sorted(mc_profiles, key=lambda x: (x["T"], x["ph"], x["eh"], x["run"]))
+    json.dump(profiles, open(fname, "w"), indent=1)
+    print("   MC profile written to %s" % fname)
+    print("   %7s %6s %6s %10s %10s %10s %10s %10s %10s" % ("T", "ph", "eh", "accepted", "multiflip", "mf_accept",
+                                                           "steps/s", "io", "tau"))
+    conditions = []
+    for x in profiles:
+        if (x["T"], x["ph"], x["eh"]) not in conditions:
+            conditions.append((x["T"], x["ph"], x["eh"]))
+    for condition in conditions:
+        runs = [x for x in profiles if (x["T"], x["ph"], x["eh"]) == condition]
+        mean = dict([(key, np.mean([x[key] for x in runs])) for key in runs[0]])
+        print("   %7.2f %6.2f %6.0f %10.3f %10.3f %10.3f %10.0f %9.1f%% %10.1f" % (
+            condition[0], condition[1], condition[2], mean["acceptance"], mean["multiflip"],
+            mean["multiflip_acceptance"], mean["steps_per_second"], 100.0 * mean["io_seconds"] / max(mean["seconds"],
+                                                                                                   1e-9),
+            mean["autocorrelation_time"]))
+    return
+
+
+def mc_seed(base_seed, i_titr, irun):
+    """Deterministic and independent seed of run irun at titration point i_titr."""
+    seq = np.random.SeedSequence([base_seed, i_titr, irun])
+    return int(seq.generate_state(1, dtype=np.uint64)[0])
+
+
+_mc_prot = None
+_mc_condition = None
+
+
+def _mc_init(prot):
+    global _mc_prot
+    _mc_prot = prot
+    return
+
+
+def _mc_job(job):
+    global _mc_condition
+    T, ph, eh, irun, seed, state, n_eq = job
+    if _mc_condition != (T, ph, eh):
+        _mc_prot.update_energy(T=T, ph=ph, eh=eh)
+        _mc_condition = (T, ph, eh)
+    random.seed(seed)
+    n = len(mc_profiles)
+    return job, mc_run(_mc_prot, T=T, ph=ph, eh=eh, irun=irun, state=state, n_eq=n_eq), mc_profiles[n:]
+
+
+def mc_sample_parallel(prot, jobs, workers):
+    """Run (T, ph, eh, irun, seed, state, n_eq) jobs in a pool of worker processes, return the final states and the
+    conformer occupancies in job order.
+
+    Workers are forked so they inherit prot, env and the current working directory.
+    """
+    import multiprocessing
+    pool = multiprocessing.get_context("fork").Pool(workers, initializer=_mc_init, initargs=(prot,))
+    results = {}
+    for job, result, profiles in pool.imap_unordered(_mc_job, jobs):
+        mc_profiles.extend(profiles)
+        T, ph, eh, irun = job[:4]
+        print("   Done run %02d at T = %.2f, ph = %5.2f and eh = %.0f mv" % (irun, T, ph, eh))
+        results[job[:4]] = result
+    pool.close()
+    pool.join()
+    return [results[job[:4]][0] for job in jobs], np.array([results[job[:4]][1] for job in jobs])
+
+
+def _point_job(job):
+    T, ph, eh, seeds, n_eq = job
+    n = len(mc_profiles)
+    return job, mc_sample(_mc_prot, T=T, ph=ph, eh=eh, seeds=seeds, n_eq=n_eq)[1], mc_profiles[n:]
+
+
+def mc_points_parallel(prot, jobs, workers):
+    """Run (T, ph, eh, seeds, n_eq) titration points, all runs of a point in one worker, in a pool of worker
+    processes. Return the conformer occupancies of the runs of every point in job order."""
+    import multiprocessing
+    pool = multiprocessing.get_context("fork").Pool(workers, initializer=_mc_init, initargs=(prot,))
+    occ = {}
+    for job, occ_runs, profiles in pool.imap_unordered(_point_job, jobs):
+        mc_profiles.extend(profiles)
+        T, ph, eh = job[:3]
+        print("   Done runs at T = %.2f, ph = %5.2f and eh = %.0f mv" % (T, ph, eh))
+        occ[job[:3]] = occ_runs
+    pool.close()
+    pool.join()
+    return [occ[job[:3]] for job in jobs]
+
+
+def grid_axes(conditions):
+    """Sorted pH and Eh values of (ph, eh) grid conditions."""
+    return sorted(set([x[0] for x in conditions])), sorted(set([x[1] for x in conditions]))
+
+
+def grid_point(prot, job):
+    T, ph, eh, i, seeds, states, n_eq = job
+    n = len(mc_profiles)
+    return i, mc_sample(prot, T=T, ph=ph, eh=eh, seeds=seeds, states=states, n_eq=n_eq), mc_profiles[n:]
+
+
+def _grid_job(job):
+    return grid_point(_mc_prot, job)
+
+
+def mc_grid(prot, T, conditions, seed, n_eq=0, warm_neq=None, workers=1):
+    """Titrate (ph, eh) grid conditions in a pool of worker processes, return the conformer occupancies of the runs
+    of every point in conditions order.
+
+    Self energies of all points are computed once before the workers fork. With warm_neq, the runs of a point start
+    from the final states of the point one pH step lower, or at the lowest pH from the point one Eh step lower, with
+    warm_neq equilibration steps per free conformer. A point is scheduled as soon as that neighbour is done, so the
+    Eh rows run side by side.
+    """
+    import queue
+    runs = env.prm["MONTE_RUNS"]
+    phs, ehs = grid_axes(conditions)
+    index = dict([(conditions[i], i) for i in range(len(conditions))])
+    prot.precompute_energy(T, conditions)
+
+    children = [[] for i in conditions]
+    ready = []
+    for i in range(len(conditions)):
+        ph, eh = conditions[i]
+        parent = None
+        if warm_neq is not None:
+            if phs.index(ph) > 0:
+                parent = index.get((phs[phs.index(ph) - 1], eh))
+            elif ehs.index(eh) > 0:
+                parent = index.get((ph, ehs[ehs.index(eh) - 1]))
+        if parent is None:
+            ready.append(i)
+        else:
+            children[parent].append(i)
+
+    def job(i, states):
+        ph, eh = conditions[i]
+        seeds = [mc_seed(seed, i, irun) for irun in range(runs)]
+        return T, ph, eh, i, seeds, states, n_eq if states is None else warm_neq
+
+    occ_runs = [None] * len(conditions)
+    done = queue.Queue()
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=_mc_init, initargs=(prot,))
+
+        def submit(i, states):
+            pool.apply_async(_grid_job, (job(i, states),), callback=done.put, error_callback=done.put)
+    else:
+        pool = None
+
+        def submit(i, states):
+            done.put(grid_point(prot, job(i, states)))
+
+    for i in ready:
+        submit(i, None)
+    for n in range(len(conditions)):
+        result = done.get()
+        if isinstance(result, Exception):
+            raise result
+        i, (states, occ), profiles = result
+        mc_profiles.extend(profiles)
+        occ_runs[i] = occ
+        if pool:
+            print("   Done runs at T = %.2f, ph = %5.2f and eh = %.0f mv" % (T, conditions[i][0], conditions[i][1]))
+        for child in children[i]:
+            submit(child, states)
+
+    if pool:
+        pool.close()
+        pool.join()
+    return occ_runs
+
+
+def write_grid_tables(prot, conditions, occ_table, crg_table, suffix=""):
+    """Write fort.38 and sumcrg of a grid titration as pH titrations at every Eh, fort.38-eh#, and Eh titrations at
+    every pH, fort.38-ph#.#, with suffix like ".err" after the table name."""
+    phs, ehs = grid_axes(conditions)
+    index = dict([(conditions[i], i) for i in range(len(conditions))])
+    for eh in ehs:
+        rows = [index[(ph, eh)] for ph in phs]
+        write_fort38(prot, "ph", phs, [occ_table[i] for i in rows], fname="fort.38-eh%.0f%s" % (eh, suffix))
+        write_sumcrg(prot, "ph", phs, [crg_table[i] for i in rows], fname="sumcrg-eh%.0f%s" % (eh, suffix))
+    for ph in phs:
+        rows = [index[(ph, eh)] for eh in ehs]
+        write_fort38(prot, "eh", ehs, [occ_table[i] for i in rows], fname="fort.38-ph%.1f%s" % (ph, suffix))
+        write_sumcrg(prot, "eh", ehs, [crg_table[i] for i in rows], fname="sumcrg-ph%.1f%s" % (ph, suffix))
+    return
+
+
+class MC_Walkers:
+    """K independent MC chains advanced together, state is a (K, n_free) array of free conformer indices.
+
+    Every chain has its own condition (T, ph, eh). Free conformers are stored by residue, so residue ir owns free
+    indices res_start[ir] to res_start[ir] + res_size[ir] - 1.
+    """
+
+    def __init__(self, prot, n_walkers, rng):
+        self.prot = prot
+        self.K = n_walkers
+        self.rng = rng
+        self.rows = np.arange(n_walkers)
+        self.pairwise = prot.free_pairwise
+        self.free_conformers = np.array(prot.free_conformers)
+        self.res_size = np.array([len(res) for res in prot.free_residues])
+        self.res_start = np.cumsum(self.res_size) - self.res_size
+        self.nbig = np.array([len(x) for x in prot.biglist])
+        self.big = np.zeros((len(prot.biglist), max(1, self.nbig.max())), dtype=int)
+        for ir in range(len(prot.biglist)):
+            self.big[ir, :self.nbig[ir]] = prot.biglist[ir]
+        self.nflips = env.prm["MONTE_FLIPS"]
+        return
+
+    def reset(self, conditions, states=None):
+        """Chain k at condition conditions[k] = (T, ph, eh), starting from states[k], a list of free residue
+        conformers, or from a random state.
+        """
+        self.b = np.zeros(self.K)
+        self.E_self = np.zeros((self.K, len(self.free_conformers)))
+        self.E_fixed = np.zeros(self.K)
+        energies = {}
+        for k in range(self.K):
+            T, ph, eh = conditions[k]
+            if (T, ph, eh) not in energies:
+                E_self_mfe = self.prot.self_energy(T=T, ph=ph, eh=eh)[1]
+                energies[(T, ph, eh)] = (E_self_mfe[self.free_conformers], self.prot.fixed_energy(E_self_mfe))
+            self.b[k] = -KCAL2KT / (T / ROOMT)
+            self.E_self[k], self.E_fixed[k] = energies[(T, ph, eh)]
+
+        n_free = len(self.res_size)
+        if states:
+            self.state = np.asarray(self.prot.free_index)[np.asarray(states, dtype=int)]
+        else:
+            self.state = self.res_start + (self.rng.random((self.K, n_free)) * self.res_size).astype(int)
+        self.E = self.self_sum(self.rows, self.rows) + get_states_pairwise(self.prot, self.free_conformers[self.state])
+        self.field = np.zeros((self.K, len(self.free_conformers)))
+        for k in range(self.K):
+            self.field[k] = self.pairwise[self.state[k]].sum(axis=0)
+        return
+
+    def flip_dE(self, iflip, old, new, flips):
+        """Energy change of old -> new in every chain on top of the flips already made in this step."""
+        pw = self.pairwise
+        rows = self.rows
+        dE = self.E_self[rows, new] - self.E_self[rows, old] + self.field[rows, new] - self.field[rows, old]
+        for ir, ic, jc in flips:
+            dE += pw[new, jc] - pw[new, ic] - pw[old, jc] + pw[old, ic]
+        self.state[self.rows, iflip] = new
+        flips.append((iflip, old, new))
+        return dE
+
+    def step(self):
+        """Propose one move in every chain and accept or reject it. Return the acceptance and the flips."""
+        rng = self.rng
+        rows = self.rows
+        flips = []
+
+        # choose new state, a different conformer of a random residue
+        ires = rng.integers(len(self.res_size), size=self.K)
+        old = self.state[rows, ires]
+        size = self.res_size[ires]
+        slot = (old - self.res_start[ires] + 1 + (rng.random(self.K) * (size - 1)).astype(int)) % size
+        dE = self.flip_dE(ires, old, self.res_start[ires] + slot, flips)
+
+        # multiflip, a chain that does not flip flips ires to itself
+        has_big = self.nbig[ires] > 0
+        self.multi = np.zeros(self.K, dtype=bool)  # chains that flipped big list residues too
+        flip_probablity = 0.5
+        for k in range(self.nflips):
+            fire = has_big & (rng.random(self.K) < flip_probablity)
+            self.multi |= fire
+            iflip = self.big[ires, (rng.random(self.K) * self.nbig[ires]).astype(int)]
+            iflip = np.where(fire, iflip, ires)
+            old = self.state[rows, iflip]
+            new = self.res_start[iflip] + (rng.random(self.K) * self.res_size[iflip]).astype(int)
+            new = np.where(fire, new, old)
+            dE += self.flip_dE(iflip, old, new, flips)
+            flip_probablity = flip_probablity / 2.0
+
+        # evaluate
+        accept = rng.random(self.K) < np.exp(np.minimum(self.b * dE, 0.0))
+        reject = ~accept
+        for ir, ic, jc in reversed(flips):
+            self.state[rows[reject], ir[reject]] = ic[reject]
+        for ir, ic, jc in flips:
+            self.field[accept] += self.pairwise[jc[accept]] - self.pairwise[ic[accept]]
+        self.E[accept] += dE[accept]
+        return accept, flips
+
+    def self_sum(self, chains, states):
+        """Fixed and self energy of the states of chains states at the conditions of chains chains."""
+        return self.E_fixed[chains] + self.E_self[chains[:, np.newaxis], self.state[states]].sum(axis=1)
+
+    def swap(self, i, j):
+        """Replica exchange of states between chains i and j, arrays of chain pairs. Return the acceptance."""
+        E_ij = self.E[j] - self.self_sum(j, j) + self.self_sum(i, j)  # state of j at condition of i
+        E_ji = self.E[i] - self.self_sum(i, i) + self.self_sum(j, i)
+        b_i = self.b[i]
+        b_j = self.b[j]
+        log_acc = b_i * E_ij + b_j * E_ji - b_i * self.E[i] - b_j * self.E[j]
+        accept = self.rng.random(len(i)) < np.exp(np.minimum(log_acc, 0.0))
+        i = i[accept]
+        j = j[accept]
+        self.state[i], self.state[j] = self.state[j], self.state[i].copy()
+        self.field[i], self.field[j] = self.field[j], self.field[i].copy()
+        self.E[i] = E_ij[accept]
+        self.E[j] = E_ji[accept]
+        return accept
+
+    def delta(self, k, flips):
+        """Conformers switched off and on in chain k by an accepted step."""
+        before = {}
+        for ir, ic, jc in flips:
+            if ir[k] not in before:
+                before[ir[k]] = ic[k]
+        off_confs = set()
+        on_confs = set()
+        for ir in before:
+            if before[ir] != self.state[k, ir]:
+                off_confs.add(self.free_conformers[before[ir]])
+                on_confs.add(self.free_conformers[self.state[k, ir]])
+        return off_confs, on_confs
+
+
+def mc_walkers(prot, T=298.15, ph=7.0, eh=0.0, n_walkers=100, seed=None, states=None, n_eq=0):
+    """MC sampling with n_walkers chains advanced together, chain k is written as run k. Return the final states and
+    the conformer occupancy of every chain.
+
+    Chain k starts from states[k] when states is given, and all chains are equilibrated for n_eq steps per free
+    conformer before they are written. With (MONTE_RHAT), chains stop when they converge as in mc_converge.
+    Written and counted steps are those of written_steps, warm when states are given. With (MONTE_RHAT), occupancy
+    leaves out about the same fraction of iterations instead. With (MONTE_PROFILE), every chain is profiled as a run.
+    """
+    print("   Titration at T = %.2f, ph = %5.2f and eh = %.0f mv with %d walkers" % (T, ph, eh, n_walkers))
+    prot.update_energy(T=T, ph=ph, eh=eh)
 
-        fh.close()
+    n_conf = sum([len(x) for x in prot.free_residues])
+    n_iter = env.prm["MONTE_NITER"]
+    tolerance = env.prm.get("MONTE_RHAT", 0.0) if n_walkers > 1 else 0.0
+    check = env.prm.get("MONTE_CHECK", 0) or max(2, n_iter // 20)
+    if states:
+        discard = env.prm.get("MONTE_DISCARD_WARM", 0.0)
+    else:
+        discard = env.prm.get("MONTE_DISCARD", 0.1)
+    if tolerance > 0.0:
+        n_steps, n_skip = n_iter * n_conf, 0
+    else:
+        n_steps, n_skip = written_steps(n_conf, warm=bool(states))
+        n_iter = (n_steps + n_conf - 1) // n_conf
+    walkers = MC_Walkers(prot, n_walkers, np.random.default_rng(seed))
+    walkers.reset([(T, ph, eh)] * n_walkers, states)
+    for iterations in range(n_eq * n_conf):
+        walkers.step()
+
+    profile = env.prm.get("MONTE_PROFILE", "f").lower() == "t"
+    if profile:
+        counters = MC_Counters(n_walkers, n_conf, n_iter)
+    fhs = []
+    for k in range(n_walkers):
+        state = walkers.free_conformers[walkers.state[k]].tolist()
+        # number of steps is not known in advance when sampling stops at convergence
+        fh = open_ms_writer(prot, T, ph, eh, k, walkers.E[k], state, 0 if tolerance > 0.0 else n_steps)
+        fhs.append(MS_Timer(fh) if profile else fh)
+
+    # rejected steps are written in one go before the next accepted step
+    pending = np.zeros(n_walkers, dtype=int)
+    blocks = MC_Blocks(check // 2)
+    occ_sum = np.zeros((n_walkers, len(walkers.free_conformers)))
+    r = np.inf
+    t = time.perf_counter()
+    for iteration in range(n_iter):
+        E_sum = np.zeros(n_walkers)
+        occ = np.zeros((n_walkers, len(walkers.free_conformers)))
+        for istep in range(min(n_conf, n_steps - iteration * n_conf)):
+            accept, flips = walkers.step()
+            pending += 1
+            for k in np.nonzero(accept)[0].tolist():
+                if pending[k] > 1:
+                    fhs[k].reject(pending[k] - 1)
+                off_confs, on_confs = walkers.delta(k, flips)
+                fhs[k].accept(walkers.E[k], off_confs, on_confs)
+            pending[accept] = 0
+            E_sum += walkers.E
+            occ[walkers.rows[:, np.newaxis], walkers.state] += 1
+            if profile:
+                counters.add(accept, walkers.multi, walkers.E)
+            if iteration * n_conf + istep + 1 == n_skip:
+                occ_sum[:] = 0
+                occ[:] = 0
+
+        occ_sum += occ
+        if tolerance > 0.0:
+            blocks.add(np.column_stack((E_sum, occ)) / n_conf)
+            if (iteration + 1) % check == 0:
+                r = blocks.rhat()
+                blocks.forget(min(int(discard * blocks.n), blocks.n // 2))
+                if r <= tolerance:
+                    break
+
+    for k in range(n_walkers):
+        if pending[k]:
+            fhs[k].reject(pending[k])
+        fhs[k].close()
+    if profile:
+        mc_profiles.extend(counters.profiles(range(n_walkers), [(T, ph, eh)] * n_walkers, range(n_walkers),
+                                             time.perf_counter() - t, [fh.seconds for fh in fhs]))
+    if tolerance > 0.0:
+        print("      Stopped at %d of %d iterations with R-hat %.3f" % (iteration + 1, n_iter, r))
+
+    occ_all = np.zeros((n_walkers, len(prot.head3list)))
+    if tolerance > 0.0:
+        m, s1, s2 = blocks.window(int(discard * blocks.n))
+        occ_all[:, walkers.free_conformers] = s1[:, 1:] / m
+    else:
+        occ_all[:, walkers.free_conformers] = occ_sum / (n_steps - n_skip)
+    return walkers.free_conformers[walkers.state].tolist(), occ_all
+
+
+def _walkers_job(job):
+    T, ph, eh, n_walkers, seed, n_eq = job
+    n = len(mc_profiles)
+    return job, mc_walkers(_mc_prot, T=T, ph=ph, eh=eh, n_walkers=n_walkers, seed=seed, n_eq=n_eq)[1], mc_profiles[n:]
+
+
+def mc_walkers_parallel(prot, jobs, workers):
+    """Run (T, ph, eh, n_walkers, seed, n_eq) titration points in a pool of worker processes. Return the conformer
+    occupancies of the chains of every point in job order."""
+    import multiprocessing
+    pool = multiprocessing.get_context("fork").Pool(workers, initializer=_mc_init, initargs=(prot,))
+    occ = {}
+    for job, occ_chains, profiles in pool.imap_unordered(_walkers_job, jobs):
+        mc_profiles.extend(profiles)
+        T, ph, eh, n_walkers = job[:4]
+        print("   Done %d walkers at T = %.2f, ph = %5.2f and eh = %.0f mv" % (n_walkers, T, ph, eh))
+        occ[job[:3]] = occ_chains
+    pool.close()
+    pool.join()
+    return [occ[job[:3]] for job in jobs]
+
+
+def mc_replicas(prot, ladder, targets, runs, seed=None, swap_interval=0, n_eq=0):
+    """Replica exchange MC.
+
+    Every run is a set of replicas, one at each condition (T, ph, eh) of ladder, advanced together. Every
+    swap_interval steps, by default one per free residue, neighbouring replicas try to swap states, alternating
+    between even and odd neighbours. The first n_eq steps per free conformer, swaps included, are an equilibration
+    that is not written. Only replicas at the ladder indices in targets are written, as run r of their
+    condition. A swap is written as part of the step it follows. Return the conformer occupancy of the written
+    replicas over the written steps after the first (MONTE_DISCARD) of them, an array of (runs, targets, conformers).
+    With (MONTE_PROFILE), every written replica is profiled as a run.
+    """
+    n_ladder = len(ladder)
+    print("   Replica exchange of %d runs over %d conditions:" % (runs, n_ladder))
+    for T, ph, eh in ladder:
+        print("      T = %.2f, ph = %5.2f and eh = %.0f mv" % (T, ph, eh))
 
+    n_free = len(prot.free_residues)
+    n_conf = sum([len(x) for x in prot.free_residues])
+    n_steps, n_skip = written_steps(n_conf)
+    swap_interval = swap_interval or n_free
+    walkers = MC_Walkers(prot, runs * n_ladder, np.random.default_rng(seed))
+    walkers.reset(ladder * runs)  # chain r * n_ladder + l is run r at ladder[l]
+
+    # neighbour pairs (l, l+1) starting from an even and from an odd l
+    pairs = []
+    for first in (0, 1):
+        i = np.array([r * n_ladder + l for r in range(runs) for l in range(first, n_ladder - 1, 2)], dtype=int)
+        pairs.append((i, i + 1))
+
+    for iterations in range(n_eq * n_conf):
+        walkers.step()
+        if (iterations + 1) % swap_interval == 0 and n_ladder > 1:
+            i, j = pairs[(iterations // swap_interval) % 2]
+            if len(i):
+                walkers.swap(i, j)
+
+    profile = env.prm.get("MONTE_PROFILE", "f").lower() == "t"
+    if profile:
+        counters = MC_Counters(walkers.K, n_conf, env.prm["MONTE_NITER"])
+    chains = []
+    fhs = []
+    for r in range(runs):
+        for l in targets:
+            k = r * n_ladder + l
+            T, ph, eh = ladder[l]
+            state = walkers.free_conformers[walkers.state[k]].tolist()
+            chains.append(k)
+            fh = open_ms_writer(prot, T, ph, eh, r, walkers.E[k], state, n_steps)
+            fhs.append(MS_Timer(fh) if profile else fh)
+    chains = np.array(chains)
+    written = walkers.state[chains].copy()
+
+    n_swap = 0
+    n_swap_accepted = 0
+    pending = np.zeros(len(chains), dtype=int)
+    occ = np.zeros((len(chains), len(walkers.free_conformers)))
+    t_start = time.perf_counter()
+    for iterations in range(n_steps):
+        accept = walkers.step()[0]
+        if (iterations + 1) % swap_interval == 0 and n_ladder > 1:
+            i, j = pairs[(iterations // swap_interval) % 2]
+            if len(i):
+                n_swap += len(i)
+                n_swap_accepted += walkers.swap(i, j).sum()
+        if profile:
+            counters.add(accept, walkers.multi, walkers.E)
+
+        pending += 1
+        changed = np.any(walkers.state[chains] != written, axis=1)
+        for t in np.nonzero(changed)[0].tolist():
+            k = chains[t]
+            if pending[t] > 1:
+                fhs[t].reject(pending[t] - 1)
+            diff = walkers.state[k] != written[t]
+            off_confs = set(walkers.free_conformers[written[t][diff]].tolist())
+            on_confs = set(walkers.free_conformers[walkers.state[k][diff]].tolist())
+            fhs[t].accept(walkers.E[k], off_confs, on_confs)
+            written[t] = walkers.state[k]
+        pending[changed] = 0
+        if iterations >= n_skip:
+            occ[np.arange(len(chains))[:, np.newaxis], written] += 1
+
+    for i in range(len(chains)):
+        if pending[i]:
+            fhs[i].reject(pending[i])
+        fhs[i].close()
+    if profile:
+        mc_profiles.extend(counters.profiles(chains, [ladder[l] for r in range(runs) for l in targets],
+                                             [r for r in range(runs) for l in targets], time.perf_counter() - t_start,
+                                             [fh.seconds for fh in fhs]))
+
+    if n_swap:
+        print("   Replica exchange accepted %d of %d swaps" % (n_swap_accepted, n_swap))
+
+    occ_all = np.zeros((len(chains), len(prot.head3list)))
+    occ_all[:, walkers.free_conformers] = occ / (n_steps - n_skip)
+    return occ_all.reshape(runs, len(targets), len(prot.head3list))
+
+
+def _replicas_job(job):
+    ladder, targets, runs, seed, swap_interval, n_eq = job
+    n = len(mc_profiles)
+    return mc_replicas(_mc_prot, ladder, targets, runs, seed=seed, swap_interval=swap_interval, n_eq=n_eq), \
+        mc_profiles[n:]
+
+
+def mc_replicas_parallel(prot, jobs, workers):
+    """Run (ladder, targets, runs, seed, swap_interval, n_eq) replica exchange jobs in a pool of worker processes.
+    Return the occupancies of mc_replicas in job order."""
+    import multiprocessing
+    pool = multiprocessing.get_context("fork").Pool(workers, initializer=_mc_init, initargs=(prot,))
+    results = pool.map(_replicas_job, jobs)
+    pool.close()
+    pool.join()
+    for occ, profiles in results:
+        mc_profiles.extend(profiles)
+    return [occ for occ, profiles in results]
+
+
+ENUM_CHUNK = 65536  # states enumerated at a time
+ENUM_PMIN = 1.0e-6  # probability of the least probable state written to the analytical accessibles
+
+
+def enumerate_states(prot, start, stop):
+    """States start to stop-1 of the full product of free residues, one row of conformers per state.
+
+    The first free residue varies fastest, as in the State_key of collectstates.py.
+    """
+    index = np.arange(start, stop, dtype=np.int64)
+    states = np.empty((len(index), len(prot.free_residues)), dtype=int)
+    for ir in range(len(prot.free_residues)):
+        res = prot.free_residues[ir]
+        index, slot = np.divmod(index, len(res))
+        states[:, ir] = np.asarray(res)[slot]
+    return states
+
+
+def enumerate_range(prot, T, start, stop, pmin=ENUM_PMIN):
+    """Boltzmann sums over states start to stop-1, relative to the largest log weight M.
+
+    Return M, partition sum Z and conformer occupancy sums, both scaled by exp(-M), and the states and energies that
+    may reach probability pmin.
+    """
+    b = -KCAL2KT / (T / ROOMT)
+    n_free = len(prot.free_residues)
+    M = -np.inf
+    Z = 0.0
+    occ = np.zeros(len(prot.head3list))
+    kept_states = []
+    kept_E = []
+    n_kept = 0
+    for a in range(start, stop, ENUM_CHUNK):
+        states = enumerate_states(prot, a, min(a + ENUM_CHUNK, stop))
+        E = get_states_energy(prot, states)
+        logw = b * E
+
+        # log-sum-exp, rescale the sums when the largest log weight goes up
+        m = max(M, logw.max())
+        scale = math.exp(M - m)
+        w = np.exp(logw - m)
+        Z = Z * scale + w.sum()
+        occ = occ * scale + np.bincount(states.ravel(), weights=np.repeat(w, n_free), minlength=len(occ))
+        M = m
+
+        keep = logw >= M + math.log(pmin)
+        kept_states.append(states[keep])
+        kept_E.append(E[keep])
+        n_kept += keep.sum()
+        if n_kept > 10 * ENUM_CHUNK:
+            states, E = prune_states(kept_states, kept_E, b, M + math.log(pmin))
+            kept_states = [states]
+            kept_E = [E]
+            n_kept = len(E)
+
+    states, E = prune_states(kept_states, kept_E, b, M + math.log(pmin))
+    return M, Z, occ, states, E
+
+
+def prune_states(states, Es, b, min_logw):
+    """Concatenate lists of states and energies, keep those with log weight >= min_logw."""
+    states = np.concatenate(states)
+    Es = np.concatenate(Es)
+    keep = b * Es >= min_logw
+    return states[keep], Es[keep]
+
+
+def _enum_job(job):
+    global _mc_condition
+    T, ph, eh, start, stop = job
+    if _mc_condition != (T, ph, eh):
+        _mc_prot.update_energy(T=T, ph=ph, eh=eh)
+        _mc_condition = (T, ph, eh)
+    return enumerate_range(_mc_prot, T, start, stop)
+
+
+def analytical_sample(prot, T=298.15, ph=7.0, eh=0.0, workers=1):
+    """Exact equilibrium by enumerating all states of free residues.
+
+    Write the states with probability >= ENUM_PMIN to ph##.#-eh#-analytical as "state:E, probability" in energy
+    order, and return the occupancy of all conformers.
+    """
+    print("   Enumerating states at T = %.2f, ph = %5.2f and eh = %.0f mv" % (T, ph, eh))
+    prot.update_energy(T=T, ph=ph, eh=eh)
+
+    total_states = 1
+    for res in prot.free_residues:
+        total_states *= len(res)
+
+    if workers > 1:
+        import multiprocessing
+        bounds = np.linspace(0, total_states, workers * 4 + 1).astype(np.int64).tolist()
+        jobs = [(T, ph, eh, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=_mc_init, initargs=(prot,))
+        parts = pool.map(_enum_job, jobs)
+        pool.close()
+        pool.join()
+    else:
+        parts = [enumerate_range(prot, T, 0, total_states)]
+
+    # merge the parts in log space
+    M = max([part[0] for part in parts])
+    Z = 0.0
+    occ = np.zeros(len(prot.head3list))
+    for part in parts:
+        scale = math.exp(part[0] - M)
+        Z += part[1] * scale
+        occ += part[2] * scale
+    occ /= Z
+    occ[prot.fixed_conformers] = prot.occ[prot.fixed_conformers]
+    logZ = M + math.log(Z)
+
+    b = -KCAL2KT / (T / ROOMT)
+    states, Es = prune_states([part[3] for part in parts], [part[4] for part in parts], b, logZ + math.log(ENUM_PMIN))
+    order = np.argsort(Es, kind="stable")
+    fname = "ph%.1f-eh%.0f-analytical" % (ph, eh)
+    lines = []
+    for i in order:
+        state = sorted(states[i].tolist())
+        lines.append("%s:%.3f, %.6e\n" % (tuple(state), Es[i], math.exp(b * Es[i] - logZ)))
+    open(fname, "w").writelines(lines)
+
+    return occ
+
+
+def write_fort38(prot, titration_type, points, occ_table, fname="fort.38"):
+    """Write occupancy of every conformer, one column per titration point."""
+    if titration_type.upper() == "EH":
+        lines = ["%-14s" % "eh" + "".join([" %5.0f" % x for x in points]) + "\n"]
+    else:
+        lines = ["%-14s" % "ph" + "".join([" %5.1f" % x for x in points]) + "\n"]
+    for ic in range(len(prot.head3list)):
+        lines.append("%s" % prot.confnames[ic] + "".join([" %5.3f" % occ[ic] for occ in occ_table]) + "\n")
+    open(fname, "w").writelines(lines)
     return
 
+
+def occupancy_stats(prot, occ_runs):
+    """Mean occupancy of all conformers and its standard error over independent runs, occ_runs has one row per run.
+
+    Fixed conformers have their fixed occupancy.
+    """
+    occ_runs = np.array(occ_runs, dtype=float).reshape(-1, len(prot.head3list))
+    occ_runs[:, prot.fixed_conformers] = prot.occ[prot.fixed_conformers]
+    return mean_stderr(occ_runs)
+
+
+def mean_stderr(x):
+    """Mean and standard error of the mean of the rows of x."""
+    n = len(x)
+    if n > 1:
+        return x.mean(axis=0), x.std(axis=0, ddof=1) / math.sqrt(n)
+    else:
+        return x.mean(axis=0), np.zeros(x.shape[1:])
+
+
+def charged_residues(prot):
+    """Names and conformers of residues that have a charged conformer."""
+    names = []
+    residues = []
+    for res in prot.residues:
+        if np.any(prot.crg[res] != 0.0):
+            confname = prot.confnames[res[0]]
+            names.append(confname[:3] + confname[5:11])
+            residues.append(res)
+    return names, residues
+
+
+def charge_stats(prot, occ_runs):
+    """Charge of every charged residue followed by the net charge, protons and electrons, as mean and standard error
+    over independent runs of conformer occupancies occ_runs."""
+    occ_runs = np.array(occ_runs, dtype=float).reshape(-1, len(prot.head3list))
+    occ_runs[:, prot.fixed_conformers] = prot.occ[prot.fixed_conformers]
+    columns = [np.dot(occ_runs[:, res], prot.crg[res]) for res in charged_residues(prot)[1]]
+    columns += [np.dot(occ_runs, prot.crg), np.dot(occ_runs, prot.nh), np.dot(occ_runs, prot.ne)]
+    return mean_stderr(np.column_stack(columns))
+
+
+def write_sumcrg(prot, titration_type, points, crg_table, fname="sumcrg"):
+    """Write charge of charged residues, net charge, protons and electrons, one column per titration point.
+
+    crg_table has a row of charge_stats() values per point.
+    """
+    if titration_type.upper() == "EH":
+        lines = ["%-14s" % "eh" + "".join([" %5.0f" % x for x in points]) + "\n"]
+    else:
+        lines = ["%-14s" % "ph" + "".join([" %5.1f" % x for x in points]) + "\n"]
+    names = charged_residues(prot)[0]
+    for i in range(len(names)):
+        lines.append("%-14s" % names[i] + "".join([" %5.2f" % crg[i] for crg in crg_table]) + "\n")
+    lines.append("-" * 14 + "------" * len(points) + "\n")
+    for i, name in zip(range(len(names), len(names) + 3), ["Net_Charge", "Protons", "Electrons"]):
+        lines.append("%-14s" % name + "".join([" %5.2f" % crg[i] for crg in crg_table]) + "\n")
+    open(fname, "w").writelines(lines)
+    return
+
+
 def validate_state(prot, state):
     # each conf in state is in free_residues
     # each res in free_residues has one and only one conf in state
     # This makes sure the state is free residues only and garauntees correct energy
-    counters = [0 for x in prot.free_residues]  # on conf occurance in each residue, should be all 1
-    outsiders = []  # on conf not in free residues, should be empty
-
-    for ic in state:
-        found = False
-        for ir in range(len(prot.free_residues)):
-            if ic in prot.free_residues[ir]:
-                counters[ir] += 1
-                found = True
-        if not found:
-            outsiders.append(ic)
+    state = np.asarray(state, dtype=int)
+    inside = (state >= 0) & (state < len(prot.conf_residue))
+    residues = np.full(len(state), -1, dtype=int)
+    residues[inside] = prot.conf_residue[state[inside]]
+    outsiders = state[residues < 0]  # on conf not in free residues, should be empty
+    counters = np.bincount(residues[residues >= 0], minlength=len(prot.free_residues))  # should be all 1
 
     matched = True
+    for ic in outsiders:
+        print("Conformer %d in microstate is not a free conformer." % ic)
+        matched = False
     for ir in range(len(counters)):
         if counters[ir] == 0:
             i_1stconf = prot.free_residues[ir][0]
@@ -595,51 +2259,72 @@ def validate_state(prot, state):
     return matched
 
 
-def get_state_energy(prot, state):
-    E = 0.0
+def validate_states(prot, states, chunk=100000):
+    """Whether every row of states, a 2-D array of conformers, has one conformer of every free residue and nothing
+    else. Rows are checked chunk at a time with one bincount of their residues."""
+    states = np.asarray(states, dtype=int)
+    n_free = len(prot.free_residues)
+    valid = np.zeros(len(states), dtype=bool)
+    if states.ndim != 2 or states.shape[1] != n_free:
+        return valid
+    for start in range(0, len(states), chunk):
+        rows = states[start:start + chunk]
+        inside = ((rows >= 0) & (rows < len(prot.conf_residue))).all(axis=1)
+        residues = prot.conf_residue[np.clip(rows, 0, len(prot.conf_residue) - 1)]
+        inside &= (residues >= 0).all(axis=1)
+        # residue counts of row i are at i * n_free, outsiders are counted past the last row
+        bins = np.where(residues >= 0, residues + np.arange(len(rows))[:, np.newaxis] * n_free, len(rows) * n_free)
+        counts = np.bincount(bins.ravel(), minlength=len(rows) * n_free + 1)[:len(rows) * n_free]
+        valid[start:start + chunk] = inside & (counts.reshape(len(rows), n_free) == 1).all(axis=1)
+    return valid
 
-    # all fixed self energy
-    for ic in prot.fixed_conformers:
-        E += prot.head3list[ic].E_self_mfe * prot.head3list[ic].occ
 
-    # minus one side of pw fixed to fixed
-    n_fixed_conformers = len(prot.fixed_conformers)
-    for i in range(n_fixed_conformers -1):
-        ic = prot.fixed_conformers[i]
-        for j in range(i+1, n_fixed_conformers):
-            jc = prot.fixed_conformers[j]
-            E -= prot.pairwise[ic][jc]*prot.head3list[ic].occ*prot.head3list[jc].occ
+def get_state_energy(prot, state):
+    # all fixed self energy, minus one side of pw fixed to fixed
+    E = prot.E_fixed
 
     # plus self on-conformers
     for ic in state:
-        E += prot.head3list[ic].E_self_mfe
+        E += prot.E_self_mfe[ic]
 
     # plus pw on-conformer to on-conformer
+    state = [prot.free_index[ic] for ic in state]
     for kc in range(len(state) - 1):
         ic = state[kc]
         for lc in range(kc+1, len(state)):
             jc = state[lc]
-            E += prot.pairwise[ic][jc]
+            E += prot.free_pairwise[ic][jc]
 
     return E
 
 
-def get_state_energy_details(prot, state):
-    E = 0.0
+def get_states_energy(prot, states):
+    """Energies of a batch of microstates, a 2-D array with one row of free residue conformers per state."""
+    states = np.asarray(states, dtype=int)
+    return prot.E_fixed + prot.E_self_mfe[states].sum(axis=1) + get_states_pairwise(prot, states)
+
 
+def get_states_pairwise(prot, states):
+    """Pairwise energy among on-conformers of a batch of microstates."""
+    states = np.asarray(states, dtype=int)
+    E = np.zeros(len(states))
+
+    # the diagonal of pw is 0 and the sum counts each pair twice
+    free_index = np.asarray(prot.free_index)
+    n_on = states.shape[1]
+    chunk = max(1, 2**22 // max(1, n_on * n_on))  # gather about 4M pairwise values at a time
+    for i in range(0, len(states), chunk):
+        fs = free_index[states[i:i+chunk]]
+        pw = prot.free_pairwise[fs[:, :, np.newaxis], fs[:, np.newaxis, :]]
+        E[i:i+chunk] += pw.sum(axis=(1, 2), dtype=float) / 2
+
+    return E
+
+
+def get_state_energy_details(prot, state):
     #print("Microstate: %s" % ",".join(["%d" % x for x in state]))
-    # all fixed self energy
-    for ic in prot.fixed_conformers:
-        E += prot.head3list[ic].E_self_mfe * prot.head3list[ic].occ
-        #print("%s %.3f" % (prot.head3list[ic].confname, prot.head3list[ic].occ))
-
-    # minus one side of pw fixed to fixed
-    n_fixed_conformers = len(prot.fixed_conformers)
-    for i in range(n_fixed_conformers -1):
-        ic = prot.fixed_conformers[i]
-        for j in range(i+1, n_fixed_conformers):
-            jc = prot.fixed_conformers[j]
-            E -= prot.pairwise[ic][jc]*prot.head3list[ic].occ*prot.head3list[jc].occ
+    # all fixed self energy, minus one side of pw fixed to fixed
+    E = prot.E_fixed
 
     #print(state, prot.fixed_conformers)
     state = list(set(state) - set(prot.fixed_conformers))
@@ -648,14 +2333,15 @@ def get_state_energy_details(prot, state):
 
     # plus self on-conformers
     for ic in state:
-        E += prot.head3list[ic].E_self_mfe
+        E += prot.E_self_mfe[ic]
 
     # plus pw on-conformer to on-conformer
+    state = [prot.free_index[ic] for ic in state]
     for kc in range(len(state) - 1):
         ic = state[kc]
         for lc in range(kc+1, len(state)):
             jc = state[lc]
-            E += prot.pairwise[ic][jc]
+            E += prot.free_pairwise[ic][jc]
 
     return E
 
@@ -665,16 +2351,18 @@ def deltaE(prot, state, off_confs, on_confs):
     Calculate delta E based on conformer difference, state is not altered
     """
     dE = 0.0
+    pw = prot.free_pairwise
+    fi = prot.free_index
     for ic in off_confs:
-        dE -= prot.head3list[ic].E_self_mfe
+        dE -= prot.E_self_mfe[ic]
         state = state - {ic}
         for jc in list(state):
-            dE -= prot.pairwise[ic][jc]
+            dE -= pw[fi[ic]][fi[jc]]
     for ic in on_confs:
-        dE += prot.head3list[ic].E_self_mfe
+        dE += prot.E_self_mfe[ic]
         for jc in list(state):
-            dE += prot.pairwise[ic][jc]
-        state = state.add(ic)
+            dE += pw[fi[ic]][fi[jc]]
+        state = state | {ic}
 
     return dE
 
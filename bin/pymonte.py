@@ -2,16 +2,68 @@
 """
 This version of MC will write all states and corresponding energy. So analysis will not depend on the energy table.
 Output:
-    microstates/ph##.#-eh#-run##.ms.gz
+    microstates/ph##.#-eh#-run##.ms.gz, or .msb.gz when (MONTE_FORMAT) is binary, none when it is none
+        .gz is .zz, .xz or no suffix when (MONTE_CODEC) is zlib, lzma or none
+    microstates/ph##.#-eh#-analytical instead when total states <= (NSTATE_MAX)
+    fort.38 and sumcrg, occupancy and charge at every titration point
+    fort.38.err and sumcrg.err, their standard error over independent runs
+    fort.38-eh#, fort.38-ph##.# and the same of sumcrg and .err instead when (TITR_TYPE) is grid, pH titrations
+        at every Eh and Eh titrations at every pH
+    microstates/mc_profile.json, performance of every run when (MONTE_PROFILE) is t
     free_residues.info
     fixed_conformers.info
     big_list.info
+    mc_cache/, conformers and pairwise interactions reused by later runs when (MONTE_CACHE) is t
 """
 
 from pymcce import *
 import time
+import argparse
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo sampling")
+    parser.add_argument("--workers", type=int, default=env.prm.get("MONTE_WORKERS", 1),
+                        help="number of worker processes for (pH/Eh, run) jobs, default (MONTE_WORKERS) or 1")
+    parser.add_argument("--seed", type=int, default=env.prm.get("MONTE_SEED"),
+                        help="base random seed, default (MONTE_SEED) or a random one")
+    parser.add_argument("--walkers", type=int, default=env.prm.get("MONTE_WALKERS", 0),
+                        help="number of MC chains advanced together per titration point, written as runs, "
+                             "default (MONTE_WALKERS) or 0 to run (MONTE_RUNS) chains one by one")
+    parser.add_argument("--replica-t", default=env.prm.get("MONTE_REPLICA_T"),
+                        help="comma separated temperature ladder for replica exchange at every titration point, "
+                             "only (MONTE_T) replicas are written, default (MONTE_REPLICA_T)")
+    parser.add_argument("--replica-ph", action="store_true",
+                        default=env.prm.get("MONTE_REPLICA_PH", "f").lower() == "t",
+                        help="replica exchange between neighbouring titration points, default (MONTE_REPLICA_PH)")
+    parser.add_argument("--swap", type=int, default=env.prm.get("MONTE_SWAP", 0),
+                        help="steps between replica swaps, default (MONTE_SWAP) or one per free residue")
+    parser.add_argument("--neq", type=int, default=env.prm.get("MONTE_NEQ", 0),
+                        help="equilibration steps per free conformer before a run is written, "
+                             "default (MONTE_NEQ) or 0")
+    parser.add_argument("--warm", action="store_true", default=env.prm.get("MONTE_WARM", "f").lower() == "t",
+                        help="start the runs of a titration point from the final states of the previous point, which "
+                             "then write only the steps a cold point counts plus (MONTE_DISCARD_WARM), "
+                             "default (MONTE_WARM)")
+    parser.add_argument("--warm-neq", type=int, default=env.prm.get("MONTE_NEQ_WARM"),
+                        help="equilibration steps per free conformer of warm started points, "
+                             "default (MONTE_NEQ_WARM) or 1/10 of the equilibration of the first point")
+    parser.add_argument("--rhat", type=float, default=env.prm.get("MONTE_RHAT", 0.0),
+                        help="stop the runs of a titration point when the R-hat of energy and occupancies is within "
+                             "this tolerance, at most (MONTE_NITER), default (MONTE_RHAT) or 0 for a fixed length")
+    parser.add_argument("--format", default=env.prm.get("MONTE_FORMAT", "text"), choices=["text", "binary", "none"],
+                        help="microstate file format, none for occupancy and charge only, default (MONTE_FORMAT)")
+    parser.add_argument("--profile", action="store_true",
+                        default=env.prm.get("MONTE_PROFILE", "f").lower() == "t",
+                        help="write acceptance, multiflip, speed and autocorrelation time of every run, walker or "
+                             "written replica to microstates/mc_profile.json, default (MONTE_PROFILE)")
+    args = parser.parse_args()
+    env.prm["MONTE_FORMAT"] = args.format
+    env.prm["MONTE_PROFILE"] = "t" if args.profile else "f"
+    env.prm["MONTE_RHAT"] = args.rhat
+    if args.warm_neq is None:
+        args.warm_neq = args.neq // 10
+    env.prm["MONTE_WORKERS"] = args.workers
+
     print("Monte Carlo sampling")
 
     timerA = time.time()
@@ -21,12 +73,6 @@ if __name__ == "__main__":
 
 
     monte_t = env.prm["MONTE_T"]
-    titration_type = env.prm["TITR_TYPE"].upper()
-    init_ph = env.prm["TITR_PH0"]
-    step_ph = env.prm["TITR_PHD"]
-    init_eh = env.prm["TITR_EH0"]
-    step_eh = env.prm["TITR_EHD"]
-    steps = env.prm["TITR_STEPS"]
 
     total_states = 1
     for res in prot.free_residues:
@@ -35,33 +81,158 @@ if __name__ == "__main__":
     timerB = time.time()
     print("   Done setting up MC in %d seconds.\n" % (timerB - timerA))
 
-    if total_states > env.prm["NSTATE_MAX"]:
-        print("   Total states %d > threshold %d" % (total_states, env.prm["NSTATE_MAX"]))
-    else:
-        print("   Total states %d <= threshold %d" % (total_states, env.prm["NSTATE_MAX"]))
-        print("   Please use analytical method ______ to analyze protein equilibrium0.")
-        sys.exit()
+    titration_type, conditions, points = titration_conditions()
+    grid = titration_type == "GRID"
+    prot.precompute_energy(monte_t, conditions)
 
     mc_prepdir()
     os.chdir(env.mc_states)
 
-    for i in range(steps):
-        # Set up pH and eh environment
-        if titration_type == "PH":
-            ph = init_ph + i * step_ph
-            eh = init_eh
-        elif titration_type == "EH":
-            ph = init_ph
-            eh = init_eh + i * step_eh
+    if total_states > env.prm["NSTATE_MAX"]:
+        print("   Total states %d > threshold %d" % (total_states, env.prm["NSTATE_MAX"]))
+    else:
+        print("   Total states %d <= threshold %d, enumerating all states" % (total_states, env.prm["NSTATE_MAX"]))
+        occ_table = []
+        for ph, eh in conditions:
+            occ_table.append(analytical_sample(prot, T=monte_t, ph=ph, eh=eh, workers=args.workers))
+        os.chdir("../")
+        crg_table = [charge_stats(prot, occ)[0] for occ in occ_table]
+        if grid:
+            write_grid_tables(prot, conditions, occ_table, crg_table)
         else:
-            print(
-                "   Error: Titration type is %s. It has to be ph or eh in line (TITR_TYPE) in run.prm" % titration_type)
-            sys.exit()
+            write_fort38(prot, titration_type, points, occ_table)
+            write_sumcrg(prot, titration_type, points, crg_table)
+        timerA = time.time()
+        print("   Done analytical solution in %d seconds.\n" % (timerA - timerB))
+        sys.exit()
+
+    if args.seed is None:
+        args.seed = random.SystemRandom().randrange(2**32)
+    print("   Base random seed is %d" % args.seed)
 
+    if args.warm and args.rhat <= 0.0 and not (args.replica_ph or args.replica_t):
+        # warm started points write only the steps a cold point counts, so they make fewer steps for the same count
+        n_conf = sum([len(res) for res in prot.free_residues])
+        n_cold, n_skip = written_steps(n_conf)
+        n_cold += args.neq * n_conf
+        n_warm = written_steps(n_conf, warm=True)[0] + args.warm_neq * n_conf
+        n_points = len(conditions)
+        print("   Warm start makes %d steps per run over %d points, cold starts %d, counting %d steps at every point" %
+              (n_cold + (n_points - 1) * n_warm, n_points, n_points * n_cold, n_cold - args.neq * n_conf - n_skip))
+        if n_warm >= n_cold:
+            print("   Warning: Warm started points make no fewer steps than cold ones, check --warm-neq and "
+                  "(MONTE_DISCARD_WARM)")
 
-        mc_sample(prot, T=monte_t, ph=ph, eh=eh)
+    # conformer occupancy of every run (chain) at every titration point
+    occ_runs = [None] * len(conditions)
+    runs = env.prm["MONTE_RUNS"]
+    if args.replica_ph and grid:
+        print("   Error: Replica exchange between titration points needs a ph or eh titration, not a grid")
+        sys.exit()
+    elif args.replica_ph:
+        ladder = [(monte_t, ph, eh) for ph, eh in conditions]
+        occ = mc_replicas(prot, ladder, list(range(len(ladder))), runs, seed=mc_seed(args.seed, 0, 0),
+                          swap_interval=args.swap, n_eq=args.neq)
+        occ_runs = [occ[:, i] for i in range(len(conditions))]
+    elif args.replica_t:
+        temperatures = sorted(set([float(x) for x in args.replica_t.split(",")] + [monte_t]))
+        jobs = []
+        for i in range(len(conditions)):
+            ph, eh = conditions[i]
+            ladder = [(T, ph, eh) for T in temperatures]
+            jobs.append((ladder, [temperatures.index(monte_t)], runs, mc_seed(args.seed, i, 0), args.swap, args.neq))
+        if args.workers > 1:
+            occ_runs = mc_replicas_parallel(prot, jobs, args.workers)
+        else:
+            for i in range(len(jobs)):
+                ladder, targets, runs, seed, swap_interval, n_eq = jobs[i]
+                occ_runs[i] = mc_replicas(prot, ladder, targets, runs, seed=seed, swap_interval=swap_interval,
+                                          n_eq=n_eq)
+    elif grid and args.walkers <= 0:
+        # points run as soon as their warm start neighbour is done
+        if args.warm:
+            print("   Warm start, equilibration of %d and then %d steps per free conformer" % (args.neq, args.warm_neq))
+        occ_runs = mc_grid(prot, monte_t, conditions, args.seed, n_eq=args.neq,
+                           warm_neq=args.warm_neq if args.warm else None, workers=args.workers)
+    elif args.warm:
+        # titration points run one after another, each starts from the final states of the previous one
+        print("   Warm start, equilibration of %d and then %d steps per free conformer" % (args.neq, args.warm_neq))
+        states = None
+        for i in range(len(conditions)):
+            ph, eh = conditions[i]
+            n_eq = args.warm_neq if states else args.neq
+            if args.walkers > 0:
+                states, occ_runs[i] = mc_walkers(prot, T=monte_t, ph=ph, eh=eh, n_walkers=args.walkers,
+                                                 seed=mc_seed(args.seed, i, 0), states=states, n_eq=n_eq)
+            elif args.workers > 1 and args.rhat <= 0.0:
+                jobs = []
+                for irun in range(runs):
+                    state = states[irun] if states else None
+                    jobs.append((monte_t, ph, eh, irun, mc_seed(args.seed, i, irun), state, n_eq))
+                states, occ_runs[i] = mc_sample_parallel(prot, jobs, args.workers)
+            else:
+                seeds = [mc_seed(args.seed, i, irun) for irun in range(runs)]
+                states, occ_runs[i] = mc_sample(prot, T=monte_t, ph=ph, eh=eh, seeds=seeds, states=states, n_eq=n_eq)
+    elif args.walkers > 0:
+        jobs = []
+        for i in range(len(conditions)):
+            ph, eh = conditions[i]
+            jobs.append((monte_t, ph, eh, args.walkers, mc_seed(args.seed, i, 0), args.neq))
+        if args.workers > 1:
+            occ_runs = mc_walkers_parallel(prot, jobs, args.workers)
+        else:
+            for i in range(len(jobs)):
+                T, ph, eh, n_walkers, seed, n_eq = jobs[i]
+                occ_runs[i] = mc_walkers(prot, T=T, ph=ph, eh=eh, n_walkers=n_walkers, seed=seed, n_eq=n_eq)[1]
+    elif args.workers > 1 and args.rhat > 0.0:
+        # runs of a titration point converge together
+        jobs = []
+        for i in range(len(conditions)):
+            ph, eh = conditions[i]
+            seeds = [mc_seed(args.seed, i, irun) for irun in range(runs)]
+            jobs.append((monte_t, ph, eh, seeds, args.neq))
+        occ_runs = mc_points_parallel(prot, jobs, args.workers)
+    elif args.workers > 1:
+        print("   Running %d jobs on %d workers" % (len(conditions) * runs, args.workers))
+        jobs = []
+        for i in range(len(conditions)):
+            ph, eh = conditions[i]
+            for irun in range(runs):
+                jobs.append((monte_t, ph, eh, irun, mc_seed(args.seed, i, irun), None, args.neq))
+        occ = mc_sample_parallel(prot, jobs, args.workers)[1]
+        occ_runs = [occ[i * runs:(i + 1) * runs] for i in range(len(conditions))]
+    else:
+        for i in range(len(conditions)):
+            ph, eh = conditions[i]
+            seeds = [mc_seed(args.seed, i, irun) for irun in range(runs)]
+            occ_runs[i] = mc_sample(prot, T=monte_t, ph=ph, eh=eh, seeds=seeds, n_eq=args.neq)[1]
 
+    if mc_profiles:
+        write_mc_profile()
     os.chdir("../")
 
+    # occupancy and charge averaged over runs, the standard error of the mean over runs goes to the .err files
+    occ_table = []
+    occ_err_table = []
+    crg_table = []
+    crg_err_table = []
+    for i in range(len(conditions)):
+        occ, occ_err = occupancy_stats(prot, occ_runs[i])
+        crg, crg_err = charge_stats(prot, occ_runs[i])
+        occ_table.append(occ)
+        occ_err_table.append(occ_err)
+        crg_table.append(crg)
+        crg_err_table.append(crg_err)
+        print("   ph = %5.2f and eh = %.0f mv: net charge %.2f +/- %.2f" % (conditions[i][0], conditions[i][1],
+                                                                          crg[-3], crg_err[-3]))
+    if grid:
+        write_grid_tables(prot, conditions, occ_table, crg_table)
+        write_grid_tables(prot, conditions, occ_err_table, crg_err_table, suffix=".err")
+    else:
+        write_fort38(prot, titration_type, points, occ_table)
+        write_fort38(prot, titration_type, points, occ_err_table, fname="fort.38.err")
+        write_sumcrg(prot, titration_type, points, crg_table)
+        write_sumcrg(prot, titration_type, points, crg_err_table, fname="sumcrg.err")
+
     timerA = time.time()
-    print("   Done MC sampling in %d seconds.\n" % (timerA - timerB))
\ No newline at end of file
+    print("   Done MC sampling in %d seconds.\n" % (timerA - timerB))
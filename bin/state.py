@@ -19,19 +19,29 @@ def analyze_state(fname):
 
     prot.update_energy(T=T, ph=ph, eh=eh)
     print("Environment: pH = %.2f eh = %.0f Temperature = %.2f K" % (ph, eh, T))
-    for line in lines:
-        state = [int(ic) for ic in line.split(",")]
-
-        if validate_state(prot, state):
-            E = get_state_energy(prot, state)
+    states = [[int(ic) for ic in line.split(",")] for line in lines if line.strip()]
+
+    # validate all states at once, up to the first bad one
+    n_free = len(prot.free_residues)
+    n = 0
+    while n < len(states) and len(states[n]) == n_free:
+        n += 1
+    valid = validate_states(prot, np.array(states[:n], dtype=int).reshape(n, n_free))
+    if not valid.all():
+        n = int(np.argmin(valid))
+    if n < len(states):
+        validate_state(prot, states[n])
+    valid = n == len(states)
+    states = states[:n]
+
+    if states:
+        for E in get_states_energy(prot, states):
             print("E = %.2f" % E)
-        else:
-            print("Not a valid state, Quitting ...")
-            return
+    if not valid:
+        print("Not a valid state, Quitting ...")
 
     return
 
-
 if __name__ == "__main__":
     prot = MC_Protein()
     fname = "states"
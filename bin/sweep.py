@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Titration at every scaling vector of a grid. Ele and vdw pairwise and the self energy terms are loaded once, and the
+energies of every vector are their linear combination.
+
+    sweep.py "ELE=0.5,1.0,2.0;DSOLV=0.8,1.0" [--workers N] [--seed S] [--neq N]
+
+Output:
+    sweep/ELE0.50-DSOLV0.80/ and so on, one folder per scaling vector with
+        fort.38 and sumcrg, occupancy and charge at every titration point
+        fort.38.err and sumcrg.err, their standard error over independent runs, not when enumerating
+        ph##.#-eh#-analytical when total states <= (NSTATE_MAX)
+        pK.out, pKa or Em and Hill coefficient fitted from fort.38
+    sweep/pK.table, pKa or Em of every ionizable residue, one column per scaling vector
+MC runs of a sweep write no microstates, and run i of titration point j has the same seed at every scaling vector.
+"""
+
+from pymcce import *
+import time
+import argparse
+import fitpka
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Titration over a grid of scaling factors")
+    parser.add_argument("grid", help="scaling factors and their values, like \"ELE=0.5,1.0,2.0;DSOLV=0.8,1.0\"")
+    parser.add_argument("--workers", type=int, default=env.prm.get("MONTE_WORKERS", 1),
+                        help="number of worker processes for titration points, default (MONTE_WORKERS) or 1")
+    parser.add_argument("--seed", type=int, default=env.prm.get("MONTE_SEED"),
+                        help="base random seed, default (MONTE_SEED) or a random one")
+    parser.add_argument("--neq", type=int, default=env.prm.get("MONTE_NEQ", 0),
+                        help="equilibration steps per free conformer before a run is counted, default (MONTE_NEQ)")
+    args = parser.parse_args()
+    env.prm["MONTE_FORMAT"] = "none"
+    env.prm["MONTE_PROFILE"] = "f"
+    env.prm["MONTE_WORKERS"] = args.workers
+
+    print("Scaling factor sweep")
+    timerA = time.time()
+    grid = scaling_grid(args.grid)
+    prot = MC_Protein()
+    scaling = MC_Scaling(prot)
+    monte_t = env.prm["MONTE_T"]
+    runs = env.prm["MONTE_RUNS"]
+    titration_type, conditions, points = titration_conditions()
+    if titration_type == "GRID":
+        print("   Error: A sweep needs a ph or eh titration in (TITR_TYPE), not a grid")
+        sys.exit()
+    if len(points) < 2:
+        print("   Error: A sweep needs at least 2 titration points in (TITR_STEPS) to fit pKa or Em")
+        sys.exit()
+
+    total_states = 1
+    for res in prot.free_residues:
+        total_states *= len(res)
+    if args.seed is None:
+        args.seed = random.SystemRandom().randrange(2**32)
+    print("   Base random seed is %d" % args.seed)
+
+    folder = "sweep"
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    timerB = time.time()
+    print("   Done setting up %d scaling vectors in %d seconds.\n" % (len(grid), timerB - timerA))
+
+    table = {}
+    columns = []
+    for vector in grid:
+        name = "-".join(["%s%.2f" % (key, vector[key]) for key in vector])
+        print("   Scaling %s" % ", ".join(["%s = %.3f" % (key, vector[key]) for key in vector]))
+        scaling.set(vector)
+        os.mkdir(os.path.join(folder, name))
+        os.chdir(os.path.join(folder, name))
+
+        if total_states <= env.prm["NSTATE_MAX"]:
+            occ_table = [analytical_sample(prot, T=monte_t, ph=ph, eh=eh, workers=args.workers)
+                         for ph, eh in conditions]
+            write_fort38(prot, titration_type, points, occ_table)
+            write_sumcrg(prot, titration_type, points, [charge_stats(prot, occ)[0] for occ in occ_table])
+        else:
+            if args.workers > 1:
+                jobs = []
+                for i in range(len(conditions)):
+                    ph, eh = conditions[i]
+                    jobs.append((monte_t, ph, eh, [mc_seed(args.seed, i, irun) for irun in range(runs)], args.neq))
+                occ_runs = mc_points_parallel(prot, jobs, args.workers)
+            else:
+                occ_runs = []
+                for i in range(len(conditions)):
+                    ph, eh = conditions[i]
+                    seeds = [mc_seed(args.seed, i, irun) for irun in range(runs)]
+                    occ_runs.append(mc_sample(prot, T=monte_t, ph=ph, eh=eh, seeds=seeds, n_eq=args.neq)[1])
+            occ_stats = [occupancy_stats(prot, occ) for occ in occ_runs]
+            crg_stats = [charge_stats(prot, occ) for occ in occ_runs]
+            write_fort38(prot, titration_type, points, [x[0] for x in occ_stats])
+            write_fort38(prot, titration_type, points, [x[1] for x in occ_stats], fname="fort.38.err")
+            write_sumcrg(prot, titration_type, points, [x[0] for x in crg_stats])
+            write_sumcrg(prot, titration_type, points, [x[1] for x in crg_stats], fname="sumcrg.err")
+
+        fit_type, fit_points, confnames, occ = fitpka.read_occupancy("fort.38")
+        names, x0, n, residuals, bound = fitpka.fit_pka(fit_type, fit_points, confnames, occ)
+        fitpka.write_pkout(fit_type, names, x0, n, residuals, bound)
+        for i in range(len(names)):
+            table.setdefault(names[i], {})[name] = bound[i] or "%.3f" % x0[i]
+        columns.append(name)
+        os.chdir("../../")
+
+    # pKa or Em of every residue against scaling vectors
+    width = max([len(x) for x in columns] + [9])
+    lines = ["%-14s" % ("pKa" if titration_type == "PH" else "Em") + "".join([" %*s" % (width, x) for x in columns])
+             + "\n"]
+    for name in table:
+        lines.append("%-14s" % name + "".join([" %*s" % (width, table[name].get(x, "")) for x in columns]) + "\n")
+    open(os.path.join(folder, "pK.table"), "w").writelines(lines)
+    print("   %s written" % os.path.join(folder, "pK.table"))
+
+    timerA = time.time()
+    print("   Done sweep in %d seconds.\n" % (timerA - timerB))